@@ -1,2 +1,2 @@
 from .scripts.build import build
-from .vault import Vault, VaultCLI, VaultSync
+from .vault import AsyncVault, Vault, VaultCLI, VaultPool, VaultSync
@@ -13,9 +13,14 @@
 # You should have received a copy of the GNU General Public License
 # along with vaultio.  If not, see <https://www.gnu.org/licenses/>.
 
+import os
 from pathlib import Path
 import shutil
+import signal
+import socket
 import subprocess
+import sys
+import time
 from tkinter import simpledialog
 import psutil
 import tkinter as tk
@@ -35,8 +40,101 @@ def kill_process_listening_on_socket(socket_path):
     print(f"No process found listening on {socket_path}")
     return False
 
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+def socket_listening(socket_path):
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(str(socket_path))
+    except (ConnectionRefusedError, FileNotFoundError):
+        return False
+    finally:
+        sock.close()
+    return True
+
+def serving_socket(pid, socket_path):
+    # The pidfile may name a process that has since exited and had its PID
+    # reused, so only a bw serve for this socket is the owner
+    try:
+        cmdline = psutil.Process(pid).cmdline()
+    except (psutil.NoSuchProcess, psutil.AccessDenied):
+        return False
+    return "serve" in cmdline and f"unix://{socket_path}" in cmdline
+
+def claim_socket(socket_path, timeout=2):
+
+    # The bw serve process owning a socket inherits an flock on the pidfile
+    # next to it, so a live owner is found without scanning every process.
+    # Returns the locked pidfile descriptor to pass to the new owner.
+
+    if socket_path is None:
+        return None
+
+    if fcntl is None:
+        kill_process_listening_on_socket(socket_path)
+        return None
+
+    Path(socket_path).parent.mkdir(parents=True, exist_ok=True)
+    fd = os.open(f"{socket_path}.pid", os.O_RDWR | os.O_CREAT, 0o600)
+
+    try:
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            pid = os.pread(fd, 32, 0).strip()
+            if pid.isdigit() and serving_socket(int(pid), socket_path):
+                try:
+                    os.kill(int(pid), signal.SIGTERM)
+                except ProcessLookupError:
+                    pass
+            deadline = time.monotonic() + timeout
+            delay = .001
+            while True:
+                try:
+                    fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    break
+                except BlockingIOError:
+                    if time.monotonic() > deadline:
+                        raise TimeoutError(f"Could not claim socket {socket_path} within {timeout} seconds")
+                    time.sleep(delay)
+                    delay = min(delay * 2, .1)
+        else:
+            if socket_listening(socket_path):
+                # Listening but not started through claim_socket
+                kill_process_listening_on_socket(socket_path)
+        if os.path.exists(socket_path):
+            os.unlink(socket_path)
+    except BaseException:
+        os.close(fd)
+        raise
+
+    return fd
+
+def release_socket(fd, pid):
+    # The child holds the lock from here on
+    if fd is None:
+        return
+    os.ftruncate(fd, 0)
+    os.pwrite(fd, str(pid).encode(), 0)
+    os.close(fd)
+
 CACHE_DIR = Path.home() / ".cache" / "vaultio"
 
+def bw_appdata_dir():
+    if "BITWARDENCLI_APPDATA_DIR" in os.environ:
+        return Path(os.environ["BITWARDENCLI_APPDATA_DIR"])
+    elif sys.platform == "darwin":
+        return Path.home() / "Library" / "Application Support" / "Bitwarden CLI"
+    elif sys.platform == "win32":
+        return Path(os.environ["APPDATA"]) / "Bitwarden CLI"
+    elif "XDG_CONFIG_HOME" in os.environ:
+        return Path(os.environ["XDG_CONFIG_HOME"]) / "Bitwarden CLI"
+    else:
+        return Path.home() / ".config" / "Bitwarden CLI"
+
 if (CACHE_DIR / "bin" / "bw").exists():
     BW_PATH = CACHE_DIR / "bin" / "bw"
 else:
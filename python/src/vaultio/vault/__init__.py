@@ -1,4 +1,7 @@
 from .vault_server import VaultServer as Vault
+from .vault_async import AsyncVaultServer as AsyncVault
+from .vault_pool import VaultServerPool as VaultPool
 from .vault_cli import VaultCLI as VaultCLI
 from .vault_sync import VaultSync as VaultSync
-from .server import HttpResponse, HttpResponseError
+from .cache import ResponseCache
+from .server import HttpResponse, HttpResponseError, RequestTimeoutError, ServerUnavailableError, Standby
@@ -14,24 +14,30 @@
 # along with vaultio.  If not, see <https://www.gnu.org/licenses/>.
 
 import base64
-from collections import deque
+from binascii import a2b_base64
+from collections import OrderedDict, deque
+from collections.abc import MutableMapping
+from concurrent.futures import ProcessPoolExecutor
 import copy
 from csv import Error
 import datetime
+import functools
 import itertools
 import re
 import sys
 import tempfile
+import threading
 import uuid
 import json
 from requests_toolbelt import MultipartEncoder
 import requests
 from getpass import getpass
 import hashlib
+from hmac import digest as hmac_digest
 import os
 from rich.prompt import Prompt
 from vaultio.util import ask_input, choose_input, password_input
-from vaultio.vault.schema import ENCRYPTED_KEYS, INTERNAL_KEYS, make_attachment
+from vaultio.vault.schema import CIPHER_ENCRYPTED_PATHS, CIPHER_TYPE_ENCRYPTED_PATHS, ENCRYPTED_KEYS, FOLDER_ENCRYPTED_PATHS, INTERNAL_KEYS, make_attachment
 
 from cryptography.hazmat.backends                   import default_backend
 from cryptography.hazmat.primitives                 import ciphers, kdf, hashes, hmac, padding
@@ -565,12 +571,73 @@ def next_choice(choices):
         return choices, choice
     except StopIteration:
         return None
-import re
 
-def decrypt_object_key(key, secrets):
-    key = decrypt_ciphertext(key, secrets)
+class KeyCache:
+
+    # LRU of unwrapped item and attachment keys keyed by the wrapping key
+    # and the encrypted key.
+    # It hangs off the vault secrets as "key_cache", so it lives as long as
+    # the unlocked session, and is shared by the keys it hands out.
+
+    def __init__(self, maxsize=1 << 16):
+        self.maxsize = maxsize
+        self.keys = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def __getstate__(self):
+        # Key material stays in this process, workers start empty
+        return dict(maxsize=self.maxsize)
+
+    def __setstate__(self, state):
+        self.__init__(state["maxsize"])
+
+    def get(self, key):
+        with self.lock:
+            value = self.keys.get(key)
+            if value is None:
+                self.misses += 1
+                return None
+            self.keys.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        with self.lock:
+            self.keys[key] = value
+            self.keys.move_to_end(key)
+            while len(self.keys) > self.maxsize:
+                self.keys.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.keys.clear()
+
+    def stats(self):
+        with self.lock:
+            return dict(size=len(self.keys), hits=self.hits, misses=self.misses)
+
+def object_key(key, cache=None):
     enc, mac = key[:32], key[32:]
-    return dict(enc=enc, mac=mac)
+    if cache is None:
+        return dict(enc=enc, mac=mac)
+    return dict(enc=enc, mac=mac, key_cache=cache)
+
+def wrapped_key(key, secrets):
+    # The same ciphertext under another wrapping key is a different key
+    return secrets["enc"], secrets["mac"], key
+
+def decrypt_object_key(key, secrets):
+    cache = secrets.get("key_cache")
+    if cache is not None:
+        value = cache.get(wrapped_key(key, secrets))
+        if value is not None:
+            return value
+    value = object_key(decrypt_ciphertext(key, secrets), cache)
+    if cache is not None:
+        cache.put(wrapped_key(key, secrets), value)
+    return value
 
 def new_object_key(secrets):
     key = os.urandom(64)
@@ -578,7 +645,7 @@ def new_object_key(secrets):
     key = encrypt_ciphertext(key, secrets)
     return key, {"enc": enc, "mac": mac}
 
-def decrypt_object(root, secrets, encrypt=False):
+def walk_object(root, secrets, encrypt=False):
     stack = []
     pattern = re.compile(r"\d\.[^,]+\|[^,]+=+")
     node = root
@@ -622,9 +689,247 @@ def decrypt_object(root, secrets, encrypt=False):
             except StopIteration:
                 node = None
 
+def compile_plan(paths):
+    # A plan is the fields to read at this level plus a sub-plan for every
+    # nested object or list of objects, so a missing object skips its paths
+    leaves = []
+    branches = {}
+    for path in paths:
+        key, _, rest = path.partition(".")
+        if not rest:
+            leaves.append(key)
+            continue
+        each = rest.startswith("*.")
+        if each:
+            rest = rest[2:]
+        branches.setdefault((key, each), []).append(rest)
+    return tuple(leaves), tuple(
+        (key, each, compile_plan(rest))
+        for (key, each), rest in branches.items()
+    )
+
+def cipher_paths(type_paths):
+    data_paths = [path.split(".", 1)[1] for path in type_paths]
+    return (
+        *CIPHER_ENCRYPTED_PATHS,
+        *type_paths,
+        *(f"data.{path}" for path in CIPHER_ENCRYPTED_PATHS),
+        *(f"data.{path}" for path in data_paths),
+    )
+
+CIPHER_PATHS = {
+    type: cipher_paths(type_paths)
+    for type, type_paths in CIPHER_TYPE_ENCRYPTED_PATHS.items()
+}
+
+CIPHER_ALL_PATHS = cipher_paths([
+    path
+    for type_paths in CIPHER_TYPE_ENCRYPTED_PATHS.values()
+    for path in type_paths
+])
+
+CIPHER_PLANS = {
+    type: compile_plan(paths)
+    for type, paths in CIPHER_PATHS.items()
+}
+
+CIPHER_PLAN = compile_plan(CIPHER_ALL_PATHS)
+
+FOLDER_PLAN = compile_plan(FOLDER_ENCRYPTED_PATHS)
+
+CIPHER_OBJECTS = ("cipherDetails", "cipher")
+
+def select_paths(paths, only):
+    # "*" is implied, so "fields.value" selects "fields.*.value" and
+    # "login" selects every path under it
+    only = [path.replace(".*", "") for path in only]
+    return [
+        path for path in paths
+        if any(
+            bare == want or bare.startswith(want + ".")
+            for bare in (path.replace(".*", ""),)
+            for want in only
+        )
+    ]
+
+@functools.lru_cache(maxsize=256)
+def projected_plan(kind, type, only):
+    if kind == "folder":
+        paths = FOLDER_ENCRYPTED_PATHS
+    else:
+        paths = CIPHER_PATHS.get(type, CIPHER_ALL_PATHS)
+    return compile_plan(select_paths(paths, only))
+
+def object_plan(node, only=None):
+    if not isinstance(node, dict):
+        return None
+    kind = node.get("object")
+    if kind in CIPHER_OBJECTS:
+        if only is not None:
+            return projected_plan("cipher", node.get("type"), only)
+        return CIPHER_PLANS.get(node.get("type"), CIPHER_PLAN)
+    if kind == "folder":
+        if only is not None:
+            return projected_plan("folder", None, only)
+        return FOLDER_PLAN
+    return None
+
+def plan_fields(node, plan, fields):
+    leaves, branches = plan
+    for key in leaves:
+        value = node.get(key)
+        if value is not None:
+            fields.append((node, key, value))
+    for key, each, branch in branches:
+        child = node.get(key)
+        if child is None:
+            continue
+        if each:
+            for item in child:
+                plan_fields(item, branch, fields)
+        else:
+            plan_fields(child, branch, fields)
+
+def collect_objects(root, secrets, objects, encrypt=False, only=None):
+
+    plan = object_plan(root, only)
+
+    if plan is not None:
+        objects.append((root, plan))
+    # A mapping of objects such as sync["ciphers"]
+    elif isinstance(root, dict) and "object" not in root and all(isinstance(node, dict) for node in root.values()):
+        for node in root.values():
+            collect_objects(node, secrets, objects, encrypt, only)
+    else:
+        # Objects without a known type still go through the generic walk
+        walk_object(root, secrets, encrypt)
+
+def decrypt_blocks(values, secrets):
+
+    # CBC decryption of a block only needs the ciphertext block before it.
+    # With each IV placed in front of its ciphertext, all the values sharing
+    # a key go through a single CBC decryptor, and the block decrypted from
+    # each IV is dropped.
+
+    mac_key = secrets["mac"]
+
+    blocks = []
+    sizes = []
+    for value in values:
+        iv, text, mac = value.partition(".")[2].split("|")[:3]
+        iv, text, mac = a2b_base64(iv), a2b_base64(text), a2b_base64(mac)
+        check_mac(mac, hmac_digest(mac_key, iv + text, "sha256"))
+        if len(iv) != 16 or not text or len(text) % 16:
+            raise Exception(CHECK_DECRYPT_MSG)
+        blocks += (iv, text)
+        sizes.append(len(text))
+
+    if not blocks:
+        return []
+
+    decryptor = Cipher(algorithms.AES(secrets["enc"]), modes.CBC(bytes(16)), backend=default_backend()).decryptor()
+    decrypted = decryptor.update(b"".join(blocks)) + decryptor.finalize()
+
+    plain = []
+    start = 0
+    for size in sizes:
+        start += 16
+        end = start + size
+        pad = decrypted[end - 1]
+        if not 1 <= pad <= 16 or decrypted[end - pad:end] != bytes((pad,)) * pad:
+            raise Exception(CHECK_DECRYPT_MSG)
+        plain.append(decrypted[start:end - pad])
+        start = end
+
+    return plain
+
+def encrypt_value(value, secrets):
+    assert isinstance(value, str)
+    return encrypt_ciphertext(value.encode("utf-8"), secrets)
+
+def object_secrets(objects, secrets):
+    # Unwrap the keys of every object that has its own in one batch
+    cache = secrets.get("key_cache")
+    value = {}
+    keyed = []
+    for node, plan in objects:
+        if any(plan) and node["object"] in CIPHER_OBJECTS and isinstance(node.get("key"), str):
+            key = None if cache is None else cache.get(wrapped_key(node["key"], secrets))
+            if key is None:
+                keyed.append(node)
+            else:
+                value[id(node)] = key
+    keys = decrypt_blocks([node["key"] for node in keyed], secrets)
+    for node, key in zip(keyed, keys):
+        key = value[id(node)] = object_key(key, cache)
+        if cache is not None:
+            cache.put(wrapped_key(node["key"], secrets), key)
+    return value
+
+def decrypt_object(root, secrets, encrypt=False, only=None):
+
+    # With only, just those paths of ciphers and folders are decrypted and
+    # the rest are left encrypted
+    if only is not None:
+        only = tuple(only)
+
+    objects = []
+    collect_objects(root, secrets, objects, encrypt, only)
+    keys = object_secrets(objects, secrets)
+
+    batches = {}
+    for node, plan in objects:
+        node_secrets = keys.get(id(node), secrets)
+        _, fields = batches.setdefault(id(node_secrets), (node_secrets, []))
+        plan_fields(node, plan, fields)
+
+    for secrets, fields in batches.values():
+        if encrypt:
+            for parent, key, value in fields:
+                parent[key] = encrypt_value(value, secrets)
+        else:
+            values = decrypt_blocks([value for *_, value in fields], secrets)
+            for (parent, key, _), value in zip(fields, values):
+                parent[key] = value.decode("utf-8")
+
+    return root
+
 def encrypt_object(root, secrets):
     return decrypt_object(root, secrets, True)
 
+def project_path(node, keys, value):
+    key, *rest = keys
+    if key not in node:
+        return
+    child = node[key]
+    if not rest or child is None:
+        value[key] = copy.deepcopy(child)
+    elif isinstance(child, list):
+        items = value.setdefault(key, [{} for _ in child])
+        for item, item_value in zip(child, items):
+            project_path(item, rest, item_value)
+    else:
+        project_path(child, rest, value.setdefault(key, {}))
+
+def project_object(node, fields):
+    # Copy of node with only the given paths
+    value = {}
+    for path in fields:
+        project_path(node, [key for key in path.split(".") if key != "*"], value)
+    return value
+
+PLAN_KEYS = ("object", "type", "key")
+
+def decrypt_fields(node, secrets, fields):
+    # Copy just the requested fields out of an encrypted object and decrypt
+    # those, along with what's needed to find its plan and key
+    extra = [key for key in PLAN_KEYS if key not in fields]
+    value = project_object(node, [*fields, *extra])
+    decrypt_object(value, secrets, only=fields)
+    for key in extra:
+        value.pop(key, None)
+    return value
+
 def download_sync(email=None, password=None, provider_choice=None, provider_token=None):
 
     if email is None:
@@ -688,21 +993,101 @@ def refresh_sync(sync):
 
 def create_vault_secrets(sync, password):
     derived_secrets = create_derived_secrets(sync["email"], password, sync["kdf"])
-    return decrypt_object_key(sync["secrets"]["enc"], derived_secrets)
-
-def decrypt_sync(sync, secrets):
-
-    ciphers = decrypt_object(copy.deepcopy(sync["ciphers"]), secrets)
-    folders = decrypt_object(copy.deepcopy(sync["folders"]), secrets)
+    secrets = decrypt_object_key(sync["secrets"]["enc"], derived_secrets)
+    secrets["key_cache"] = KeyCache()
+    return secrets
+
+def crypt_objects(objects, secrets, encrypt=False):
+    return decrypt_object(copy.deepcopy(objects), secrets, encrypt)
+
+def split_objects(objects, parts):
+    items = list(objects.items())
+    size = max(1, -(-len(items) // parts))
+    return [dict(items[i:i + size]) for i in range(0, len(items), size)]
+
+PENDING = object()
+
+class LazyObjects(MutableMapping):
+
+    # Mapping of object ids to decrypted objects that decrypts each one on
+    # first access. The encrypted mapping is shared, not copied.
+
+    def __init__(self, encrypted, secrets):
+        self.encrypted = encrypted
+        self.secrets = secrets
+        self.objects = dict.fromkeys(encrypted, PENDING)
+
+    def __getitem__(self, key):
+        value = self.objects[key]
+        if value is PENDING:
+            value = self.objects[key] = crypt_objects(self.encrypted[key], self.secrets)
+        return value
+
+    def __setitem__(self, key, value):
+        self.objects[key] = value
+
+    def __delitem__(self, key):
+        del self.objects[key]
+
+    def __iter__(self):
+        return iter(self.objects)
+
+    def __len__(self):
+        return len(self.objects)
+
+    def is_loaded(self, key):
+        return self.objects[key] is not PENDING
+
+    def loaded(self):
+        return {key: value for key, value in self.objects.items() if value is not PENDING}
+
+def crypt_sync(sync, secrets, encrypt=False, workers=None, executor=None):
+
+    if encrypt and isinstance(sync["ciphers"], LazyObjects):
+        # Objects that were never decrypted are still encrypted as they are
+        lazy = sync["ciphers"]
+        loaded = lazy.loaded()
+        value = crypt_sync(dict(sync, ciphers=loaded), secrets, encrypt, workers, executor)
+        value["ciphers"] = {
+            key: value["ciphers"][key] if key in loaded else lazy.encrypted[key]
+            for key in lazy
+        }
+        return value
+
+    if workers is None and executor is None:
+        ciphers = crypt_objects(sync["ciphers"], secrets, encrypt)
+        folders = crypt_objects(sync["folders"], secrets, encrypt)
+        return dict(ciphers=ciphers, folders=folders)
+
+    if executor is None:
+        # Most of the work holds the GIL, so only processes scale
+        with ProcessPoolExecutor(workers) as executor:
+            return crypt_sync(sync, secrets, encrypt, workers, executor)
+
+    # A few chunks per worker so one slow chunk doesn't hold up the rest
+    parts = (workers or os.cpu_count() or 1) * 4
+    futures = [
+        executor.submit(crypt_objects, chunk, secrets, encrypt)
+        for chunk in split_objects(sync["ciphers"], parts)
+    ]
+    folders = crypt_objects(sync["folders"], secrets, encrypt)
+
+    # Merge in submission order so the result has the order of the input
+    ciphers = {}
+    for future in futures:
+        ciphers.update(future.result())
 
     return dict(ciphers=ciphers, folders=folders)
 
-def encrypt_sync(sync, secrets):
+def decrypt_sync(sync, secrets, workers=None, executor=None, lazy=False):
+    if lazy:
+        ciphers = LazyObjects(sync["ciphers"], secrets)
+        folders = crypt_objects(sync["folders"], secrets)
+        return dict(ciphers=ciphers, folders=folders)
+    return crypt_sync(sync, secrets, False, workers, executor)
 
-    ciphers = encrypt_object(copy.deepcopy(sync["ciphers"]), secrets)
-    folders = encrypt_object(copy.deepcopy(sync["folders"]), secrets)
-
-    return dict(ciphers=ciphers, folders=folders)
+def encrypt_sync(sync, secrets, workers=None, executor=None):
+    return crypt_sync(sync, secrets, True, workers, executor)
 
 UPDATE_TYPES = {
     "cipher",
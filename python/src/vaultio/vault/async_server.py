@@ -0,0 +1,576 @@
+# This file is part of vaultio.
+#
+# vaultio is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# vaultio is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with vaultio.  If not, see <https://www.gnu.org/licenses/>.
+
+import asyncio
+from collections import deque
+import itertools
+import json
+import os
+import socket
+import time
+
+from vaultio.util import SOCK_SUPPORT, release_socket
+from vaultio.vault.server import FORM_BOUNDARY, SOCKETPAIR_DEFAULT, ConnectionClosedError, FileRange, HttpParser, HttpResponseError, IDEMPOTENT_METHODS, JsonItemParser, bw_serve_args, file_post_body, file_pre_body, json_body, request_head
+
+class AsyncHttpResponse:
+
+    def __init__(self, status, reason, headers, conn, parser, chunks, release, recv_sz):
+        self.status = status
+        self.reason = reason
+        self.headers = headers
+        self.conn = conn
+        self.parser = parser
+        self.initial = chunks
+        self.release = release
+        self.recv_sz = recv_sz
+        self.body = None
+        self.finished = False
+        self.loop = asyncio.get_running_loop()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.finish()
+
+    def __del__(self):
+        # Dropped unread, hand the connection back so later requests on it
+        # don't wait forever
+        if not self.finished and not self.loop.is_closed():
+            self.finished = True
+            self.loop.call_soon_threadsafe(asyncio.ensure_future, self.release(self.conn, self.parser))
+
+    async def recv_views(self):
+        for chunk in self.initial:
+            yield chunk
+        self.initial = ()
+        parser = self.parser
+        while not parser.done:
+            data = await self.conn.recv(self.recv_sz)
+            if not data:
+                if parser.eof():
+                    break
+                raise ConnectionClosedError("Connection closed before end of response")
+            for view in parser.feed(data):
+                yield view
+        self.conn.unrecv(parser.tail)
+
+    async def finish(self):
+        if self.finished:
+            return
+        self.finished = True
+        await self.release(self.conn, self.parser)
+
+    async def aclose(self):
+        await self.finish()
+
+    async def chunks(self):
+        try:
+            async for view in self.recv_views():
+                yield bytes(view)
+        finally:
+            await self.finish()
+
+    async def buffer(self, check=False):
+        # The body as it was assembled, which may be a bytearray
+        if check: await self.check()
+        if self.body is None:
+            parser = self.parser
+            try:
+                if parser.state == "body" and parser.remaining is not None and not self.conn.pending:
+                    # Content-Length is known, let the stream reader assemble it
+                    bfr = b"".join(self.initial)
+                    self.initial = ()
+                    if parser.remaining:
+                        bfr += await self.conn.recv_exactly(parser.remaining)
+                    parser.remaining = 0
+                    parser.next_state("done")
+                    self.body = bfr
+                else:
+                    bfr = bytearray()
+                    async for view in self.recv_views():
+                        bfr += view
+                    self.body = bfr
+            finally:
+                await self.finish()
+        return self.body
+
+    async def bytes(self, check=False):
+        if not isinstance(await self.buffer(check), bytes):
+            self.body = bytes(self.body)
+        return self.body
+
+    async def content(self, check=False):
+        return (await self.buffer(check)).decode()
+
+    async def save(self, dest, check=False):
+        if check: await self.check()
+        if isinstance(dest, (str, os.PathLike)):
+            with open(dest, "wb") as fp:
+                return await self.save(fp)
+        size = 0
+        try:
+            async for view in self.recv_views():
+                dest.write(view)
+                size += len(view)
+        finally:
+            await self.finish()
+        return size
+
+    async def check(self):
+        if self.status == 200:
+            return
+        else:
+            raise HttpResponseError(self.status, self.reason, self.headers, await self.content())
+
+    async def json(self, check=False):
+        return json.loads(await self.buffer(check))
+
+class AsyncConnection:
+
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self.closed = False
+        self.reusable = True
+        self.created = time.monotonic()
+        self.last_used = self.created
+        self.requests = 0
+        self.bytes_sent = 0
+        self.bytes_recv = 0
+        self.pending = b""
+        # Ordering for requests pipelined on a shared connection
+        self.send_lock = asyncio.Lock()
+        self.last_done = None
+
+    async def send_chunks(self, chunks, send_sz):
+        for chunk in chunks:
+            if isinstance(chunk, FileRange):
+                await self.writer.drain()
+                if chunk.count:
+                    loop = asyncio.get_running_loop()
+                    await loop.sendfile(self.writer.transport, chunk.fp, chunk.offset, chunk.count)
+                    self.bytes_sent += chunk.count
+                continue
+            self.writer.write(chunk)
+            self.bytes_sent += len(chunk)
+            if self.writer.transport.get_write_buffer_size() >= send_sz:
+                await self.writer.drain()
+        await self.writer.drain()
+
+    async def recv(self, size):
+        if self.pending:
+            chunk, self.pending = self.pending, b""
+            return chunk
+        chunk = await self.reader.read(size)
+        self.bytes_recv += len(chunk)
+        return chunk
+
+    async def recv_exactly(self, size):
+        try:
+            chunk = await self.reader.readexactly(size)
+        except asyncio.IncompleteReadError:
+            raise ConnectionClosedError("Connection closed before end of response")
+        self.bytes_recv += len(chunk)
+        return chunk
+
+    def unrecv(self, chunk):
+        if chunk:
+            self.pending = bytes(chunk) + self.pending
+
+    def alive(self):
+        if self.closed or not self.reusable or self.pending:
+            return False
+        return not (self.reader.at_eof() or self.writer.is_closing())
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.writer.close()
+
+    def stats(self):
+        now = time.monotonic()
+        return dict(
+            requests=self.requests,
+            bytes_sent=self.bytes_sent,
+            bytes_recv=self.bytes_recv,
+            age=now - self.created,
+            idle=now - self.last_used,
+        )
+
+class AsyncConnectionPool:
+
+    def __init__(self, connect, size=8):
+        self.connect = connect
+        self.size = size
+        self.idle = deque()
+        self.conns = set()
+        self.slots = asyncio.Semaphore(size)
+        self.connects = 0
+        self.reuses = 0
+        self.discards = 0
+
+    async def acquire(self):
+        await self.slots.acquire()
+        try:
+            while self.idle:
+                conn = self.idle.pop()
+                if conn.alive():
+                    self.reuses += 1
+                    return conn
+                self._drop(conn)
+            reader, writer = await self.connect()
+            conn = AsyncConnection(reader, writer)
+            self.conns.add(conn)
+            self.connects += 1
+            return conn
+        except BaseException:
+            self.slots.release()
+            raise
+
+    def release(self, conn, reuse=True):
+        conn.last_used = time.monotonic()
+        if reuse and conn.reusable and not conn.closed:
+            self.idle.append(conn)
+        else:
+            self._drop(conn)
+        self.slots.release()
+
+    def _drop(self, conn):
+        conn.close()
+        self.conns.discard(conn)
+        self.discards += 1
+
+    def close(self):
+        idle, self.idle = self.idle, deque()
+        for conn in idle:
+            self._drop(conn)
+
+    def stats(self):
+        return dict(
+            size=self.size,
+            idle=len(self.idle),
+            connects=self.connects,
+            reuses=self.reuses,
+            discards=self.discards,
+            connections=[conn.stats() for conn in self.conns],
+        )
+
+class AsyncServer:
+
+    def __init__(self, socks=None, host=None, port=None, sock_path=None, send_sz=65536, recv_sz=65536, serve=True, wait=True, bw_path=None, pool_size=8):
+
+        if socks is None and host is None and sock_path is None:
+            if SOCK_SUPPORT:
+                if SOCKETPAIR_DEFAULT:
+                    socks = socket.socketpair()
+                else:
+                    sock_dir = os.path.join(os.path.expanduser("~"), ".cache", "vaultio", "socket")
+                    sock_path = os.path.join(sock_dir, "serve.sock")
+            else:
+                host = "localhost"
+                port = int(8087)
+
+        self.socks = socks
+        self.host = host
+        self.port = port
+        self.sock_path = sock_path
+
+        self.send_sz = send_sz
+        self.recv_sz = recv_sz
+        self.serve = serve
+        self.wait = wait
+
+        self.bw_path = bw_path
+
+        self.conn = None
+        if socks is None:
+            self.pool = AsyncConnectionPool(self.connect_socket, pool_size)
+        else:
+            self.pool = None
+
+        self.proc = None
+
+    async def __aenter__(self):
+        await self.start()
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.end()
+
+    async def serve_socket(self):
+        args, kwds, lock_fd = bw_serve_args(self.socks, self.host, self.port, self.sock_path, None, self.bw_path)
+        try:
+            self.proc = await asyncio.create_subprocess_exec(*args, **kwds)
+        except BaseException:
+            release_socket(lock_fd, "")
+            raise
+        release_socket(lock_fd, self.proc.pid)
+        if self.socks is not None:
+            # Only the child keeps its end, so its exit is seen as EOF
+            self.socks[1].close()
+        return self.proc
+
+    async def start(self):
+
+        if self.proc is None and self.serve:
+            await self.serve_socket()
+
+        if self.socks is not None and self.conn is None:
+            reader, writer = await asyncio.open_unix_connection(sock=self.socks[0])
+            self.conn = AsyncConnection(reader, writer)
+
+        if self.wait:
+            await self.wait_socket()
+
+    async def end(self):
+
+        if self.pool is not None:
+            self.pool.close()
+
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+        if self.sock_path and os.path.exists(self.sock_path):
+            os.unlink(self.sock_path)
+
+        if self.proc is not None:
+            if self.proc.returncode is None:
+                self.proc.terminate()
+            await self.proc.wait()
+            self.proc = None
+
+    async def connect_socket(self):
+        if self.sock_path is not None:
+            return await asyncio.open_unix_connection(self.sock_path)
+        else:
+            assert self.host is not None
+            return await asyncio.open_connection(self.host, self.port)
+
+    async def wait_socket(self, timeout=5):
+        if self.socks is not None:
+            return
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        delay = .001
+        while True:
+            if self.proc is not None and self.proc.returncode is not None:
+                raise ConnectionClosedError(f"bw serve exited with code {self.proc.returncode}")
+            try:
+                reader, writer = await self.connect_socket()
+            except (ConnectionRefusedError, FileNotFoundError):
+                if loop.time() > deadline:
+                    raise TimeoutError(f"Could not connect to socket {self.sock_path} within {timeout} seconds")
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, .1)
+            else:
+                writer.close()
+                return
+
+    async def request_header(self, conn):
+
+        parser = HttpParser()
+        chunks = []
+
+        while not parser.headers_done:
+            data = await conn.recv(self.recv_sz)
+            if not data:
+                raise ConnectionClosedError(f"Couldn't parse header:\n{bytes(parser.line).decode()}")
+            chunks.extend(bytes(view) for view in parser.feed(data))
+
+        if parser.headers.get("Connection", "").lower() == "close":
+            conn.reusable = False
+        if parser.remaining is None and parser.state == "body":
+            conn.reusable = False
+
+        return parser, chunks
+
+    async def release_pooled(self, conn, parser):
+        self.pool.release(conn, reuse=parser.done)
+
+    async def drain(self, conn, parser):
+        while not parser.done:
+            data = await conn.recv(self.recv_sz)
+            if not data:
+                if parser.eof():
+                    break
+                raise ConnectionClosedError("Connection closed before end of response")
+            parser.feed(data)
+        conn.unrecv(parser.tail)
+
+    async def discard_response(self, conn, prev, done):
+        # A request was cancelled after it was sent, its response still has
+        # to be read off the shared connection before the next one
+        try:
+            if prev is not None:
+                await prev
+            parser, chunks = await self.request_header(conn)
+            await self.drain(conn, parser)
+        finally:
+            done.set_result(None)
+
+    async def _request_pooled(self, req_chunks, replay):
+        conn = await self.pool.acquire()
+        reused = conn.requests > 0
+        try:
+            try:
+                conn.requests += 1
+                await conn.send_chunks(req_chunks(), self.send_sz)
+                parser, chunks = await self.request_header(conn)
+            except (ConnectionClosedError, BrokenPipeError, ConnectionResetError):
+                # bw serve closed an idle keep-alive connection under us
+                if not (reused and replay):
+                    raise
+                self.pool.release(conn, reuse=False)
+                conn = None
+                conn = await self.pool.acquire()
+                conn.requests += 1
+                await conn.send_chunks(req_chunks(), self.send_sz)
+                parser, chunks = await self.request_header(conn)
+        except BaseException:
+            if conn is not None:
+                self.pool.release(conn, reuse=False)
+            raise
+        return conn, parser, chunks, self.release_pooled
+
+    async def _request_shared(self, req_chunks):
+        conn = self.conn
+        loop = asyncio.get_running_loop()
+
+        async with conn.send_lock:
+            prev = conn.last_done
+            done = loop.create_future()
+            conn.last_done = done
+            try:
+                conn.requests += 1
+                await conn.send_chunks(req_chunks(), self.send_sz)
+            except BaseException:
+                conn.reusable = False
+                done.set_result(None)
+                raise
+
+        try:
+            if prev is not None:
+                await asyncio.shield(prev)
+            parser, chunks = await self.request_header(conn)
+        except asyncio.CancelledError:
+            asyncio.ensure_future(self.discard_response(conn, prev, done))
+            raise
+        except BaseException:
+            done.set_result(None)
+            raise
+
+        async def release(conn, parser):
+            try:
+                if not parser.done:
+                    await self.drain(conn, parser)
+                conn.last_used = time.monotonic()
+            finally:
+                done.set_result(None)
+
+        return conn, parser, chunks, release
+
+    async def request(self, endpoint, method, headers=None, body=None, content_type=None, params=None, content_length=None):
+
+        head = request_head(endpoint, method, headers, content_type, params, content_length)
+
+        if body is None:
+            body = ()
+
+        req_chunks = lambda: itertools.chain((head,), body)
+
+        if self.pool is not None:
+            replay = method in IDEMPOTENT_METHODS and isinstance(body, (tuple, list))
+            conn, parser, chunks, release = await self._request_pooled(req_chunks, replay)
+        else:
+            conn, parser, chunks, release = await self._request_shared(req_chunks)
+
+        return AsyncHttpResponse(parser.status, parser.reason, parser.headers, conn, parser, chunks, release, self.recv_sz)
+
+    def stats(self):
+        if self.pool is not None:
+            return self.pool.stats()
+        elif self.conn is not None:
+            return self.conn.stats()
+        else:
+            return None
+
+    async def request_bytes(self, endpoint, method, headers=None, value=None, params=None):
+        body, content_length = json_body(value)
+        async with await self.request(endpoint, method, headers, body, "application/json", params, content_length) as resp:
+            return await resp.bytes(check=True)
+
+    async def request_text(self, endpoint, method, headers=None, value=None, params=None):
+        return (await self.request_bytes(endpoint, method, headers, value, params)).decode()
+
+    async def request_json(self, endpoint, method, headers=None, value=None, params=None):
+        body, content_length = json_body(value)
+        async with await self.request(endpoint, method, headers, body, "application/json", params, content_length) as resp:
+            return await resp.json(check=True)
+
+    async def request_json_many(self, requests, limit=32):
+        # Run the requests concurrently, on the socketpair they are
+        # pipelined and on a pool they spread over the connections
+        sem = asyncio.Semaphore(limit)
+
+        async def run(req):
+            async with sem:
+                return await self.request_json(**req)
+
+        return await asyncio.gather(*(run(req) for req in requests))
+
+    async def request_chunks(self, endpoint, method, headers=None, value=None, params=None):
+        body, content_length = json_body(value)
+        async with await self.request(endpoint, method, headers, body, "application/json", params, content_length) as resp:
+            await resp.check()
+            async for chunk in resp.chunks():
+                yield chunk
+
+    async def request_json_items(self, endpoint, method, path, headers=None, value=None, params=None):
+        body, content_length = json_body(value)
+        async with await self.request(endpoint, method, headers, body, "application/json", params, content_length) as resp:
+            await resp.check()
+            parser = JsonItemParser(path)
+            async for chunk in resp.chunks():
+                for item in parser.feed(chunk):
+                    yield item
+            for item in parser.close():
+                yield item
+
+    async def request_download(self, endpoint, method, dest, headers=None, value=None, params=None):
+        body, content_length = json_body(value)
+        async with await self.request(endpoint, method, headers, body, "application/json", params, content_length) as resp:
+            return await resp.save(dest, check=True)
+
+    async def request_file(self, endpoint, method, headers=None, fpath=None, params=None):
+
+        boundary=FORM_BOUNDARY
+        content_type=f"multipart/form-data; boundary={boundary}"
+
+        if fpath is None:
+            async with await self.request(endpoint, method, headers, None, content_type, params, 0) as resp:
+                return await resp.json(check=True)
+
+        pre_body = file_pre_body(fpath, boundary)
+        post_body = file_post_body(boundary)
+
+        with open(fpath, "rb") as fp:
+            file_size = os.fstat(fp.fileno()).st_size
+            body = (pre_body, FileRange(fp, 0, file_size), post_body)
+            content_length = len(pre_body) + file_size + len(post_body)
+            async with await self.request(endpoint, method, headers, body, content_type, params, content_length) as resp:
+                return await resp.json(check=True)
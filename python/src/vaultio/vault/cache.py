@@ -0,0 +1,147 @@
+# This file is part of vaultio.
+#
+# vaultio is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# vaultio is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with vaultio.  If not, see <https://www.gnu.org/licenses/>.
+
+from collections import OrderedDict
+import threading
+import time
+
+from .server import RequestTimeoutError
+
+def request_key(endpoint, params=None):
+    return endpoint, tuple(sorted(params.items())) if params else None
+
+class ResponseCache:
+
+    # LRU of response bodies keyed by (endpoint, params) with a TTL. Bodies
+    # are kept as bytes so every hit decodes a fresh object for the caller.
+
+    def __init__(self, maxsize=1024, ttl=60):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        # Bumped on every invalidation so a read that raced a write isn't stored
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+
+    def key(self, endpoint, params=None):
+        return request_key(endpoint, params)
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            expires, value = entry
+            if expires is not None and time.monotonic() > expires:
+                del self.entries[key]
+                self.expirations += 1
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value, generation):
+        expires = None if self.ttl is None else time.monotonic() + self.ttl
+        with self.lock:
+            if generation != self.generation:
+                return
+            self.entries[key] = expires, value
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, match):
+        with self.lock:
+            self.generation += 1
+            keys = [key for key in self.entries if match(key[0])]
+            for key in keys:
+                del self.entries[key]
+            self.invalidations += len(keys)
+
+    def clear(self):
+        with self.lock:
+            self.generation += 1
+            self.invalidations += len(self.entries)
+            self.entries.clear()
+
+    def stats(self):
+        with self.lock:
+            return dict(
+                size=len(self.entries),
+                hits=self.hits,
+                misses=self.misses,
+                evictions=self.evictions,
+                expirations=self.expirations,
+                invalidations=self.invalidations,
+            )
+
+class Flight:
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
+
+class SingleFlight:
+
+    # Concurrent calls with the same key wait for the first one and share
+    # its result instead of each making the request
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.flights = {}
+        self.calls = 0
+        self.shared = 0
+
+    def do(self, key, fn, timeout=None):
+
+        with self.lock:
+            flight = self.flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self.flights[key] = Flight()
+                self.calls += 1
+            else:
+                self.shared += 1
+
+        if leader:
+            try:
+                flight.value = fn()
+            except BaseException as e:
+                flight.error = e
+                raise
+            finally:
+                with self.lock:
+                    del self.flights[key]
+                flight.done.set()
+            return flight.value
+
+        if not flight.done.wait(timeout):
+            raise RequestTimeoutError("Timed out waiting for a shared request")
+        if flight.error is not None:
+            raise flight.error
+        return flight.value
+
+    def stats(self):
+        with self.lock:
+            return dict(calls=self.calls, shared=self.shared, inflight=len(self.flights))
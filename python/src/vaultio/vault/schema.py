@@ -38,6 +38,13 @@ ENCRYPTED_KEYS = {
     "phone",
     "ssn",
     "username",
+    "passportNumber",
+    "licenseNumber",
+
+    # SSH key object
+    "privateKey",
+    "publicKey",
+    "keyFingerprint",
 
     # Secure note
     "secureNote",
@@ -97,9 +104,46 @@ CIPHER_TYPE_DEFAULTS = {
             "licenseNumber": None
         }
     },
-    5: {},  # Hidden fields — typically user-defined `fields` used
+    5: {  # SSH Key
+        "sshKey": {
+            "privateKey": None,
+            "publicKey": None,
+            "keyFingerprint": None
+        }
+    },
+}
+
+# Paths of the encrypted fields of each object, "*" stands for every entry
+# of a list. The legacy "data" copy of a cipher holds the same fields with
+# the type object flattened into it.
+
+CIPHER_ENCRYPTED_PATHS = (
+    "name",
+    "notes",
+    "fields.*.name",
+    "fields.*.value",
+    "passwordHistory.*.password",
+    "attachments.*.fileName",
+)
+
+CIPHER_TYPE_ENCRYPTED_PATHS = {
+    1: (  # Login
+        "login.username",
+        "login.password",
+        "login.totp",
+        "login.uri",
+        "login.uris.*.uri",
+    ),
+    2: (),  # Secure Note
+    3: tuple(f"card.{key}" for key in CIPHER_TYPE_DEFAULTS[3]["card"]),
+    4: tuple(f"identity.{key}" for key in CIPHER_TYPE_DEFAULTS[4]["identity"]),
+    5: tuple(f"sshKey.{key}" for key in CIPHER_TYPE_DEFAULTS[5]["sshKey"]),
 }
 
+FOLDER_ENCRYPTED_PATHS = (
+    "name",
+)
+
 def make_cipher(cipher: dict) -> dict:
     from copy import deepcopy
 
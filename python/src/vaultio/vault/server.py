@@ -13,20 +13,26 @@
 # You should have received a copy of the GNU General Public License
 # along with vaultio.  If not, see <https://www.gnu.org/licenses/>.
 
+import codecs
+from collections import deque
+from contextlib import contextmanager
+import contextvars
+import errno
 import itertools
 import json
 import mimetypes
 import os
 from pathlib import Path
-import re
 import shutil
 import socket
+import stat
 import subprocess
+import threading
 import time
 from email.utils import encode_rfc2231
 from urllib.parse import urlencode
 
-from vaultio.util import BW_PATH, CACHE_DIR, SOCK_SUPPORT, kill_process_listening_on_socket
+from vaultio.util import BW_PATH, CACHE_DIR, SOCK_SUPPORT, claim_socket, release_socket
 
 class HttpResponseError(Exception):
 
@@ -44,18 +50,47 @@ class HttpResponse:
         self.reason = reason
         self.headers = headers
         self.chunks = chunks
+        self.body = None
 
-    def bytes(self, check=False):
+    def buffer(self, check=False):
+        # The body as the transport assembled it, which may be a bytearray
         if check: self.check()
-        return b"".join(
-            chunk for chunk in self.chunks
-        )
+        if self.body is None:
+            if hasattr(self.chunks, "send"):
+                # Ask the transport for the whole body in one buffer
+                self.body = self.chunks.send(True)
+                for _ in self.chunks:
+                    pass
+            else:
+                self.body = b"".join(
+                    chunk for chunk in self.chunks
+                )
+        return self.body
+
+    def bytes(self, check=False):
+        if not isinstance(self.buffer(check), bytes):
+            self.body = bytes(self.body)
+        return self.body
 
     def content(self, check=False):
+        return self.buffer(check).decode()
+
+    def save(self, dest, check=False):
         if check: self.check()
-        return "".join(
-            chunk.decode() for chunk in self.chunks
-        )
+        if isinstance(dest, (str, os.PathLike)):
+            with open(dest, "wb") as fp:
+                return self.save(fp)
+        if hasattr(self.chunks, "send"):
+            # Let the transport write the body to the file directly
+            size = self.chunks.send(dest)
+            for _ in self.chunks:
+                pass
+            return size
+        size = 0
+        for chunk in self.chunks:
+            dest.write(chunk)
+            size += len(chunk)
+        return size
 
     def check(self):
         if self.status == 200:
@@ -64,7 +99,602 @@ class HttpResponse:
             raise HttpResponseError(self.status, self.reason, self.headers, self.content())
 
     def json(self, check=False):
-        return json.loads(self.content(check))
+        return json.loads(self.buffer(check))
+
+class HttpParseError(ValueError):
+    pass
+
+class HttpHeaders(dict):
+
+    # Repeated headers are joined with ", " as in RFC 9110 and the
+    # individual values are kept for get_all. Lookups ignore case.
+
+    def __init__(self):
+        super().__init__()
+        self.names = {}
+        self.values = {}
+
+    def add(self, name, value):
+        key = name.lower()
+        if key in self.names:
+            self.values[key].append(value)
+            super().__setitem__(self.names[key], ", ".join(self.values[key]))
+        else:
+            self.names[key] = name
+            self.values[key] = [value]
+            super().__setitem__(name, value)
+
+    def __getitem__(self, name):
+        return super().__getitem__(self.names.get(name.lower(), name))
+
+    def __contains__(self, name):
+        return isinstance(name, str) and name.lower() in self.names
+
+    def get(self, name, default=None):
+        return self[name] if name in self else default
+
+    def get_all(self, name):
+        return list(self.values.get(name.lower(), ()))
+
+class HttpParser:
+
+    # Incremental HTTP/1.1 response parser. Header and chunk-size lines are
+    # accumulated in a small line buffer and searched only over new bytes,
+    # body bytes are handed back as memoryview slices of the fed buffer.
+
+    MAX_LINE = 65536
+
+    def __init__(self):
+        self.state = "status"
+        self.line = bytearray()
+        self.status = None
+        self.reason = None
+        self.headers = HttpHeaders()
+        self.remaining = None
+        self.headers_done = False
+        self.done = False
+        self.tail = b""
+
+    def feed(self, data, start=0, end=None):
+        if end is None:
+            end = len(data)
+        view = memoryview(data)
+        chunks = []
+        pos = start
+        while pos < end and not self.done:
+            if self.state in ("body", "chunk_data"):
+                if self.remaining is None:
+                    take = end - pos
+                else:
+                    take = min(self.remaining, end - pos)
+                chunks.append(view[pos:pos + take])
+                pos += take
+                if self.remaining is not None:
+                    self.remaining -= take
+                    if self.remaining == 0:
+                        self.next_state("chunk_end" if self.state == "chunk_data" else "done")
+            else:
+                idx = data.find(b"\n", pos, end)
+                if idx < 0:
+                    self.line += view[pos:end]
+                    pos = end
+                    if len(self.line) > self.MAX_LINE:
+                        raise HttpParseError("HTTP line too long")
+                else:
+                    self.line += view[pos:idx + 1]
+                    pos = idx + 1
+                    line = bytes(self.line).rstrip(b"\r\n")
+                    self.line.clear()
+                    self.parse_line(line)
+        if self.done:
+            self.tail = view[pos:end]
+        return chunks
+
+    def eof(self):
+        # Only a body without Content-Length or chunking may end at EOF
+        if self.state == "body" and self.remaining is None:
+            self.next_state("done")
+            return True
+        return False
+
+    def next_state(self, state):
+        self.state = state
+        if state == "done":
+            self.done = True
+
+    def parse_line(self, line):
+        if self.state == "status":
+            if not line:
+                return
+            try:
+                version, status, *reason = line.decode("latin-1").split(" ", 2)
+                status = int(status)
+            except ValueError:
+                raise HttpParseError(f"Bad status line: {line!r}")
+            if not version.startswith("HTTP/"):
+                raise HttpParseError(f"Bad status line: {line!r}")
+            self.status = status
+            self.reason = reason[0] if reason else ""
+            self.next_state("headers")
+        elif self.state in ("headers", "trailers"):
+            if line:
+                name, sep, value = line.decode("latin-1").partition(":")
+                if not sep:
+                    raise HttpParseError(f"Bad header line: {line!r}")
+                self.headers.add(name.strip(), value.strip())
+            elif self.state == "trailers":
+                self.next_state("done")
+            else:
+                self.end_headers()
+        elif self.state == "chunk_size":
+            try:
+                size = int(line.split(b";", 1)[0].strip(), 16)
+            except ValueError:
+                raise HttpParseError(f"Bad chunk size: {line!r}")
+            if size == 0:
+                self.next_state("trailers")
+            else:
+                self.remaining = size
+                self.next_state("chunk_data")
+        elif self.state == "chunk_end":
+            if line:
+                raise HttpParseError(f"Bad chunk terminator: {line!r}")
+            self.next_state("chunk_size")
+
+    def end_headers(self):
+        if 100 <= self.status < 200:
+            # Interim response, the final one follows
+            self.headers = HttpHeaders()
+            self.next_state("status")
+            return
+        self.headers_done = True
+        encoding = self.headers.get("Transfer-Encoding", "").lower()
+        if self.status in (204, 304):
+            self.next_state("done")
+        elif "chunked" in encoding:
+            self.next_state("chunk_size")
+        elif "Content-Length" in self.headers:
+            self.remaining = int(self.headers["Content-Length"])
+            self.next_state("body" if self.remaining else "done")
+        else:
+            self.remaining = None
+            self.next_state("body")
+
+class JsonIncomplete(Exception):
+    pass
+
+class JsonItemParser:
+
+    # Push parser yielding the elements of the array found by following
+    # the object keys in path. Structural characters are consumed one at a
+    # time and complete values are decoded with raw_decode as soon as
+    # enough bytes have arrived, so only the current element is buffered.
+
+    WHITESPACE = " \t\r\n"
+    DELIMITERS = ",:]}" + WHITESPACE
+
+    def __init__(self, path):
+        self.path = path
+        self.depth = 0
+        self.state = "object" if path else "array"
+        self.decoder = json.JSONDecoder()
+        self.utf8 = codecs.getincrementaldecoder("utf-8")()
+        self.bfr = ""
+        self.pos = 0
+        self.eof = False
+        # An item stays here until its delimiter arrives, since a step that
+        # runs out of input is replayed from the start
+        self.pending = None
+
+    def feed(self, data):
+        self.bfr = self.bfr[self.pos:] + self.utf8.decode(data)
+        self.pos = 0
+        return self.parse()
+
+    def close(self):
+        self.bfr = self.bfr[self.pos:] + self.utf8.decode(b"", final=True)
+        self.pos = 0
+        self.eof = True
+        return self.parse()
+
+    def parse(self):
+        items = []
+        while self.state != "done":
+            pos = self.pos
+            try:
+                self.step(items)
+            except JsonIncomplete:
+                self.pos = pos
+                if self.eof:
+                    raise ValueError("Unexpected end of JSON document")
+                break
+        return items
+
+    def step(self, items):
+        if self.state == "object":
+            self.expect("{")
+            self.state = "first_key"
+        elif self.state == "first_key":
+            if self.peek() == "}":
+                self.pos += 1
+                self.state = "done"
+            else:
+                self.state = "key"
+        elif self.state == "key":
+            name = self.value()
+            self.expect(":")
+            if name != self.path[self.depth]:
+                self.state = "skip"
+            else:
+                self.depth += 1
+                self.state = "object" if self.depth < len(self.path) else "array"
+        elif self.state == "skip":
+            self.value()
+            self.state = "key" if self.expect(",}") == "," else "done"
+        elif self.state == "array":
+            self.expect("[")
+            if self.peek() == "]":
+                self.pos += 1
+                self.state = "done"
+            else:
+                self.state = "item"
+        elif self.state == "item":
+            self.pending = self.value()
+            self.state = "item_end"
+        elif self.state == "item_end":
+            self.state = "item" if self.expect(",]") == "," else "done"
+            items.append(self.pending)
+            self.pending = None
+
+    def peek(self):
+        while self.pos < len(self.bfr) and self.bfr[self.pos] in self.WHITESPACE:
+            self.pos += 1
+        if self.pos == len(self.bfr):
+            raise JsonIncomplete()
+        return self.bfr[self.pos]
+
+    def expect(self, chars):
+        char = self.peek()
+        if char not in chars:
+            raise ValueError(f"Expected one of {chars!r} but found {char!r}")
+        self.pos += 1
+        return char
+
+    def value(self):
+        self.peek()
+        try:
+            value, end = self.decoder.raw_decode(self.bfr, self.pos)
+        except json.JSONDecodeError:
+            if self.eof:
+                raise
+            raise JsonIncomplete()
+        # A number at the end of the buffer may still be incomplete
+        if not self.eof and (end == len(self.bfr) or self.bfr[end] not in self.DELIMITERS):
+            raise JsonIncomplete()
+        self.pos = end
+        return value
+
+def iter_json_items(chunks, path):
+    parser = JsonItemParser(path)
+    for chunk in chunks:
+        yield from parser.feed(chunk)
+    yield from parser.close()
+
+class ConnectionClosedError(ConnectionError):
+    pass
+
+class ServerUnavailableError(ConnectionError):
+    pass
+
+class RequestTimeoutError(TimeoutError):
+    pass
+
+def remaining(deadline):
+    if deadline is None:
+        return None
+    timeout = deadline - time.monotonic()
+    if timeout <= 0:
+        raise RequestTimeoutError("Request deadline exceeded")
+    return timeout
+
+# Errors that mean bw serve went away rather than rejected the request
+SERVER_ERRORS = (ConnectionClosedError, BrokenPipeError, ConnectionResetError, ConnectionRefusedError, FileNotFoundError)
+
+IDEMPOTENT_METHODS = ("GET", "HEAD", "OPTIONS")
+
+class FileRange:
+
+    # Request body part sent from a file descriptor with sendfile
+
+    def __init__(self, fp, offset, count):
+        self.fp = fp
+        self.offset = offset
+        self.count = count
+
+    def __len__(self):
+        return self.count
+
+class Connection:
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.closed = False
+        self.reusable = True
+        self.created = time.monotonic()
+        self.last_used = self.created
+        self.requests = 0
+        self.bytes_sent = 0
+        self.bytes_recv = 0
+        self.pending = b""
+        self.scratch = None
+        self.deadline = None
+        self.timed = False
+        self.bulk = False
+        # Parsers of responses still owed for requests that timed out
+        self.late = []
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def settimeout(self):
+        # Every blocking call gets the time left before the deadline
+        if self.deadline is not None:
+            self.sock.settimeout(remaining(self.deadline))
+            self.timed = True
+        elif self.timed:
+            self.sock.settimeout(None)
+            self.timed = False
+
+    def clear_deadline(self):
+        self.deadline = None
+        if self.timed and not self.closed:
+            self.sock.settimeout(None)
+            self.timed = False
+
+    def expire(self, e):
+        # The stream stopped mid request, it can't be reused
+        self.reusable = False
+        raise RequestTimeoutError("Request deadline exceeded") from e
+
+    # A deadline that has passed before a send leaves the stream as it was,
+    # only a send cut off by the socket timeout poisons it
+
+    def sendall(self, data):
+        self.settimeout()
+        try:
+            self.sock.sendall(data)
+        except TimeoutError as e:
+            self.expire(e)
+        self.bytes_sent += len(data)
+
+    def sendmsg(self, bufs):
+        self.settimeout()
+        try:
+            if hasattr(self.sock, "sendmsg"):
+                n = self.sock.sendmsg(bufs)
+            else:
+                n = self.sock.send(bufs[0])
+        except TimeoutError as e:
+            self.expire(e)
+        self.bytes_sent += n
+        return n
+
+    def sendfile(self, file_range):
+        self.settimeout()
+        try:
+            n = self.sock.sendfile(file_range.fp, file_range.offset, file_range.count)
+        except TimeoutError as e:
+            self.expire(e)
+        if n != file_range.count:
+            raise ConnectionClosedError(f"Sent {n} of {file_range.count} file bytes")
+        self.bytes_sent += n
+        return n
+
+    def recv(self, size):
+        if self.pending:
+            chunk, self.pending = self.pending, b""
+            return chunk
+        # A response cut off by the deadline can still be read later, so
+        # the connection stays usable
+        self.settimeout()
+        try:
+            chunk = self.sock.recv(size)
+        except TimeoutError as e:
+            raise RequestTimeoutError("Request deadline exceeded") from e
+        self.bytes_recv += len(chunk)
+        return chunk
+
+    def recv_into(self, view):
+        if self.pending:
+            n = min(len(self.pending), len(view))
+            view[:n] = self.pending[:n]
+            self.pending = self.pending[n:]
+            return n
+        self.settimeout()
+        try:
+            n = self.sock.recv_into(view)
+        except TimeoutError as e:
+            raise RequestTimeoutError("Request deadline exceeded") from e
+        self.bytes_recv += n
+        return n
+
+    def buffer(self, size):
+        # Scratch receive buffer reused across responses
+        if self.scratch is None or len(self.scratch) < size:
+            self.scratch = bytearray(size)
+        return self.scratch
+
+    def unrecv(self, chunk):
+        # Bytes read past the end of a response belong to the next one
+        if chunk:
+            self.pending = bytes(chunk) + self.pending
+
+    def alive(self):
+        if self.closed or not self.reusable or self.pending:
+            return False
+        self.clear_deadline()
+        # An idle keep-alive socket has nothing to read. EOF means the
+        # server closed it, anything else means the stream is out of sync.
+        # MSG_DONTWAIT doesn't exist on Windows, so the socket is switched
+        # to non-blocking for the peek instead.
+        self.sock.setblocking(False)
+        try:
+            self.sock.recv(1, socket.MSG_PEEK)
+        except BlockingIOError:
+            return True
+        except OSError:
+            return False
+        finally:
+            self.sock.setblocking(True)
+        return False
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            self.sock.close()
+        except OSError:
+            pass
+
+    def stats(self):
+        now = time.monotonic()
+        return dict(
+            requests=self.requests,
+            bytes_sent=self.bytes_sent,
+            bytes_recv=self.bytes_recv,
+            age=now - self.created,
+            idle=now - self.last_used,
+        )
+
+# Request classes in the order they are served
+PRIORITIES = ("interactive", "bulk")
+
+PRIORITY = contextvars.ContextVar("priority", default=None)
+
+class PriorityLock:
+
+    # A lock handed to waiting interactive requests before waiting bulk
+    # requests, first come first served within a class
+
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.held = False
+        self.waiting = {priority: deque() for priority in PRIORITIES}
+
+    def first(self):
+        for priority in PRIORITIES:
+            if self.waiting[priority]:
+                return self.waiting[priority][0]
+        return None
+
+    def acquire(self, priority="interactive", timeout=None):
+        ticket = object()
+        queue = self.waiting[priority]
+        with self.cond:
+            queue.append(ticket)
+            acquired = self.cond.wait_for(lambda: not self.held and self.first() is ticket, timeout)
+            queue.remove(ticket)
+            if acquired:
+                self.held = True
+            else:
+                self.cond.notify_all()
+            return acquired
+
+    def release(self):
+        with self.cond:
+            self.held = False
+            self.cond.notify_all()
+
+class ConnectionPool:
+
+    def __init__(self, connect, size=8, bulk_size=None):
+        self.connect = connect
+        self.size = size
+        self.idle = deque()
+        self.conns = set()
+        self.lock = threading.Lock()
+        self.slots = threading.BoundedSemaphore(size)
+        # Bulk requests may only hold some of the connections so the rest
+        # stay free for interactive ones
+        if bulk_size is None:
+            bulk_size = max(1, size // 2)
+        self.bulk_slots = threading.BoundedSemaphore(bulk_size)
+        self.connects = 0
+        self.reuses = 0
+        self.discards = 0
+
+    def acquire(self, deadline=None, priority="interactive"):
+        bulk = priority == "bulk"
+        if bulk and not self.bulk_slots.acquire(timeout=remaining(deadline)):
+            raise RequestTimeoutError("Timed out waiting for a pooled connection")
+        try:
+            conn = self.acquire_slot(deadline)
+        except BaseException:
+            if bulk:
+                self.bulk_slots.release()
+            raise
+        conn.bulk = bulk
+        return conn
+
+    def acquire_slot(self, deadline=None):
+        if not self.slots.acquire(timeout=remaining(deadline)):
+            raise RequestTimeoutError("Timed out waiting for a pooled connection")
+        try:
+            while True:
+                with self.lock:
+                    conn = self.idle.pop() if self.idle else None
+                if conn is None:
+                    break
+                if conn.alive():
+                    with self.lock:
+                        self.reuses += 1
+                    return conn
+                self._drop(conn)
+            conn = Connection(self.connect(remaining(deadline)))
+            with self.lock:
+                self.conns.add(conn)
+                self.connects += 1
+            return conn
+        except BaseException:
+            self.slots.release()
+            raise
+
+    def release(self, conn, reuse=True):
+        conn.last_used = time.monotonic()
+        bulk, conn.bulk = conn.bulk, False
+        if reuse and conn.reusable and not conn.closed:
+            with self.lock:
+                self.idle.append(conn)
+        else:
+            self._drop(conn)
+        self.slots.release()
+        if bulk:
+            self.bulk_slots.release()
+
+    def _drop(self, conn):
+        conn.close()
+        with self.lock:
+            self.conns.discard(conn)
+            self.discards += 1
+
+    def close(self):
+        with self.lock:
+            idle, self.idle = self.idle, deque()
+        for conn in idle:
+            self._drop(conn)
+
+    def stats(self):
+        with self.lock:
+            conns = list(self.conns)
+            return dict(
+                size=self.size,
+                idle=len(self.idle),
+                connects=self.connects,
+                reuses=self.reuses,
+                discards=self.discards,
+                connections=[conn.stats() for conn in conns],
+            )
 
 def require_bw():
     if BW_PATH is None:
@@ -74,15 +704,15 @@ def require_bw_socks():
     if not SOCK_SUPPORT:
         raise Exception("BW CLI supporting socket serve not found (>2025.8.0). Try `vaultio build` to resolve dependencies.")
 
-def bw_serve(socks=None, host=None, port=None, sock_path=None, fd=None, bw_path=None, **kwds):
+def bw_serve_args(socks=None, host=None, port=None, sock_path=None, fd=None, bw_path=None, **kwds):
     if BW_PATH is None:
         raise Exception("BW CLI supporting socket serve not found. Try `vaultio build` to resolve dependencies.")
-    kill_process_listening_on_socket(sock_path)
 
     if bw_path is None:
         bw_path = BW_PATH
 
     args = [bw_path, "serve", "--hostname"]
+    lock_fd = None
 
     if socks is not None:
         require_bw_socks()
@@ -95,6 +725,9 @@ def bw_serve(socks=None, host=None, port=None, sock_path=None, fd=None, bw_path=
         args +=  [f"fd+listening://{fd}"]
     elif sock_path is not None:
         require_bw_socks()
+        lock_fd = claim_socket(sock_path)
+        if lock_fd is not None:
+            kwds["pass_fds"] = (lock_fd,)
         args +=  [f"unix://{sock_path}"]
     else:
         assert host is not None
@@ -103,18 +736,106 @@ def bw_serve(socks=None, host=None, port=None, sock_path=None, fd=None, bw_path=
     if port is not None:
         args += ["--port", str(port)]
 
-    return subprocess.Popen(
-        args,
-        **kwds,
-        stdout=subprocess.DEVNULL,
-        stderr=subprocess.DEVNULL
-    )
+    kwds["stdout"] = subprocess.DEVNULL
+    kwds["stderr"] = subprocess.DEVNULL
+
+    return args, kwds, lock_fd
+
+def bw_serve(socks=None, host=None, port=None, sock_path=None, fd=None, bw_path=None, **kwds):
+    args, kwds, lock_fd = bw_serve_args(socks, host, port, sock_path, fd, bw_path, **kwds)
+    try:
+        proc = subprocess.Popen(args, **kwds)
+    except BaseException:
+        release_socket(lock_fd, "")
+        raise
+    release_socket(lock_fd, proc.pid)
+    return proc
+
+def request_head(endpoint, method, headers=None, content_type=None, params=None, content_length=None, keep_alive=True):
+
+    if params is not None:
+        endpoint=f"{endpoint}?{urlencode(params)}"
+
+    req_chunks = [
+        f"{method} {endpoint} HTTP/1.1",
+        "Host: localhost"
+    ]
+
+    if headers is not None:
+        req_chunks.extend(f"{k}: {v}" for k, v in headers.items())
+
+    if keep_alive:
+        req_chunks.append("Connection: keep-alive")
+    else:
+        req_chunks.append("Connection: disconnect")
+
+    if method in ("POST", "PUT") or content_length is not None:
+
+        if content_length is not None:
+            content_length = str(content_length)
+        else:
+            content_length = "0"
+
+        req_chunks.append(f"Content-Length: {content_length}")
+
+        if content_type:
+            req_chunks.append(f"Content-Type: {content_type}")
+
+    return ("\r\n".join(req_chunks) + "\r\n\r\n").encode("utf-8")
+
+def json_body(value):
+    if value is None:
+        return None, None
+    value = json.dumps(value).encode()
+    return (value,), len(value)
+
+FORM_BOUNDARY = "----PyFormBoundary"
+
+def file_pre_body(fpath, boundary):
+    filename = encode_rfc2231(os.path.basename(fpath))
+    mime_type, _ = mimetypes.guess_type(fpath) or "application/octet-stream"
+    mime_type = mime_type or "application/octet-stream"
+    field_name = "file"
+
+    return ("\r\n".join((
+        f"--{boundary}",
+        f'Content-Disposition: form-data; name="{field_name}"; filename*={filename}',
+        f"Content-Type: {mime_type}",
+    )) + "\r\n\r\n").encode()
+
+def file_post_body(boundary):
+    return f"\r\n--{boundary}--\r\n".encode()
 
 SOCKETPAIR_DEFAULT = True
 
+IOV_MAX = 1024
+
+SPLICE_SUPPORT = hasattr(os, "splice")
+SPLICE_SZ = 1 << 16
+
+if SPLICE_SUPPORT:
+    import fcntl
+
+def spliceable(fd):
+    # splice into a file opened for appending fails with EINVAL
+    mode = os.fstat(fd).st_mode
+    return stat.S_ISREG(mode) and not fcntl.fcntl(fd, fcntl.F_GETFL) & os.O_APPEND
+
+def file_fileno(fp):
+    try:
+        return fp.fileno()
+    except (AttributeError, OSError, ValueError):
+        return None
+
 class Server:
 
-    def __init__(self, socks=None, host=None, port=None, sock_path=None, fd=None, send_sz=4096, recv_sz=4096, serve=True, wait=True, bw_path=None):
+    def __init__(self, socks=None, host=None, port=None, sock_path=None, fd=None, send_sz=4096, recv_sz=4096, serve=True, wait=True, bw_path=None, pool_size=8, max_recv_sz=1 << 20, env=None, standby=None, supervise=False, retries=3, backoff=.05, breaker=5, cooldown=30, timeout=None):
+
+        proc = None
+
+        if standby is not None and socks is None and host is None and sock_path is None and fd is None:
+            # Take over a warm spare, a replacement is spawned in the background
+            socks, proc = standby.take()
 
         if socks is None and host is None and sock_path is None and fd is None:
             if SOCK_SUPPORT:
@@ -136,20 +857,60 @@ class Server:
 
         self.send_sz = send_sz
         self.recv_sz = recv_sz
+        self.max_recv_sz = max_recv_sz
         self.serve = serve
         self.wait = wait
 
         self.bw_path = bw_path
+        self.env = env
+        self.pool_size = pool_size
+        # Default per request timeout in seconds
+        self.timeout = timeout
+
+        # Supervised mode respawns bw serve when it dies and retries
+        # idempotent requests. After `breaker` failed respawns in a row the
+        # circuit opens and requests fail fast for `cooldown` seconds.
+        self.supervise = supervise
+        self.retries = retries
+        self.backoff = backoff
+        self.breaker = breaker
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened = None
+        self.respawns = 0
+        self.respawn_lock = threading.Lock()
+        # Session key replayed into a respawned bw serve
+        self.session = None
+
+        # Threads share the socketpair one request at a time, interactive
+        # requests first
+        self.conn_lock = PriorityLock()
+        self.conn_owner = None
+
+        if socks is not None:
+            self.conn = Connection(socks[0])
+            self.pool = None
+        elif fd is None:
+            self.conn = None
+            self.pool = ConnectionPool(self.connect_socket, pool_size)
+        else:
+            self.conn = None
+            self.pool = None
 
-        self.proc = None
+        self.proc = proc
         self.start()
 
         self.bw_path = bw_path
 
     def serve_socket(self):
-        if self.sock_path and os.path.exists(self.sock_path):
-            os.unlink(self.sock_path)
-        self.proc = bw_serve(self.socks, self.host, self.port, self.sock_path, self.fd, self.bw_path)
+        env = self.env
+        if self.session is not None:
+            env = dict(os.environ if env is None else env, BW_SESSION=self.session)
+        kwds = {} if env is None else dict(env=env)
+        self.proc = bw_serve(self.socks, self.host, self.port, self.sock_path, self.fd, self.bw_path, **kwds)
+        if self.socks is not None:
+            # Only the child keeps its end, so its exit is seen as EOF
+            self.socks[1].close()
         return self.proc
 
     def start(self):
@@ -167,6 +928,9 @@ class Server:
 
     def end(self):
 
+        if self.pool is not None:
+            self.pool.close()
+
         if self.sock_path and os.path.exists(self.sock_path):
             os.unlink(self.sock_path)
 
@@ -175,40 +939,113 @@ class Server:
             self.proc.wait()
             self.proc = None
 
-    def connect_socket(self):
+    def respawn(self, proc, failed=True):
+
+        # Replace the bw serve process `proc` unless another request
+        # already did. Only a failed process counts toward the breaker.
+
+        with self.respawn_lock:
+
+            if self.proc is not proc:
+                return
+
+            if failed:
+                if self.opened is None and self.failures >= self.breaker:
+                    self.opened = time.monotonic()
+
+                if self.opened is not None:
+                    if time.monotonic() - self.opened < self.cooldown:
+                        raise ServerUnavailableError(f"bw serve failed {self.failures} times in a row")
+                    # Half open, one more attempt before failing fast again
+                    self.opened = time.monotonic()
+
+                self.failures += 1
+
+            self.end()
+
+            if self.socks is not None:
+                self.socks[0].close()
+                self.socks = socket.socketpair()
+                self.conn = Connection(self.socks[0])
+            elif self.pool is not None:
+                self.pool = ConnectionPool(self.connect_socket, self.pool_size)
+
+            try:
+                self.start()
+            except Exception as e:
+                raise ServerUnavailableError("Could not respawn bw serve") from e
+
+            self.respawns += 1
+
+    def ensure_serving(self):
+        if self.opened is not None or (self.proc is not None and self.proc.poll() is not None):
+            self.respawn(self.proc)
+
+    def _request_supervised(self, method, attempt):
+
+        retry = method in IDEMPOTENT_METHODS
+        delay = self.backoff
+
+        for i in itertools.count():
+            self.ensure_serving()
+            proc = self.proc
+            chunks = attempt()
+            try:
+                header = next(chunks)
+            except SERVER_ERRORS:
+                chunks.close()
+                if self.serve:
+                    self.respawn(proc)
+                if not retry or i >= self.retries:
+                    raise
+                time.sleep(delay)
+                delay *= 2
+                continue
+            target = yield header
+            if target is not None:
+                yield chunks.send(target)
+            yield from chunks
+            return
+
+    def connect_socket(self, timeout=None):
         assert self.socks is None
-        if self.sock_path is not None:
-            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
-            sock.connect(self.sock_path)
-        elif self.fd is not None:
-            sock = socket.socket(fileno=self.fd)
-        else:
-            assert self.host is not None
-            if self.port is not None:
-                sock = socket.create_connection((self.host, self.port))
+        try:
+            if self.sock_path is not None:
+                sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                sock.settimeout(timeout)
+                sock.connect(self.sock_path)
+            elif self.fd is not None:
+                sock = socket.socket(fileno=self.fd)
             else:
-                sock = socket.create_connection((self.host,))
+                assert self.host is not None
+                if self.port is not None:
+                    sock = socket.create_connection((self.host, self.port), timeout)
+                else:
+                    sock = socket.create_connection((self.host,), timeout)
+        except TimeoutError as e:
+            raise RequestTimeoutError("Timed out connecting to bw serve") from e
+        sock.settimeout(None)
         return sock
 
-    def wait_socket(self):
-        start = time.time()
-        timeout = 5
-        interval = .2
-        while self.sock_path is not None and not os.path.exists(self.sock_path):
-            # Socket path doesn't exist
-            time.sleep(interval)
-        while self.socks is None:
+    def wait_socket(self, timeout=5):
+        if self.socks is not None or self.fd is not None:
+            return
+        deadline = time.monotonic() + timeout
+        delay = .001
+        while True:
+            if self.proc is not None and self.proc.poll() is not None:
+                raise ConnectionClosedError(f"bw serve exited with code {self.proc.returncode}")
             try:
-                with self.connect_socket():
-                    # Socket exists and connected
-                    return
-            except (ConnectionRefusedError, FileNotFoundError) as e:
-                print(e)
-                # Socket exists but isn't ready yet
-                time.sleep(interval)
-                if time.time() - start > timeout:
+                sock = self.connect_socket()
+            except (ConnectionRefusedError, FileNotFoundError):
+                # Socket path doesn't exist or isn't listening yet
+                if time.monotonic() > deadline:
                     raise TimeoutError(f"Could not connect to socket {self.sock_path} within {timeout} seconds")
-            time.sleep(interval)
+                time.sleep(delay)
+                delay = min(delay * 2, .1)
+            else:
+                sock.close()
+                return
 
     def __enter__(self):
         return self
@@ -226,204 +1063,605 @@ class Server:
                     # print(f"Error removing socket: {e}")
                     pass
 
-    def parse_header(self, re_header, bfr):
-        m = re_header.match(bfr)
-
-        if m:
-            status = int(m.group("status").decode())
-            reason = m.group("reason").decode()
-            headers = dict(line.split(": ") for line in m.group("headers").decode().splitlines())
-            chunk = bfr[m.end():]
-            return status, reason, headers, chunk
-        else:
-            return None
+    def request_header(self, sock, parser):
 
-    def request_header(self, sock):
-
-        re_header = re.compile("\r\n".join((
-            r"HTTP/1.1 (?P<status>\d{3}) (?P<reason>[^\r\n]+)",
-            r"(?P<headers>(?:[^\r\n]+:\s*[^\r\n]*\r\n)*)",
-            ""
-        )).encode("utf-8"))
-
-        bfr = bytearray()
-
-        while True:
-            chunk = sock.recv(self.recv_sz)
-            if not chunk:
-                raise Exception(f"Couldn't parse header:\n{bfr.decode()}")
-            bfr += chunk
-            header = self.parse_header(re_header, bfr)
-            if header:
-                return header
-
-    def recv_chunks(self, sock, chunk, headers):
-
-        if "Content-Length" in headers:
-            content_length = int(headers["Content-Length"])
-        else:
-            content_length = None
+        chunks = []
 
-        yield chunk
+        while not parser.headers_done:
+            data = sock.recv(self.recv_sz)
+            if not data:
+                raise ConnectionClosedError(f"Couldn't parse header:\n{bytes(parser.line).decode()}")
+            chunks.extend(self.own_chunks(parser.feed(data), data))
 
-        if content_length is not None:
-            content_length -= len(chunk)
+        return chunks
 
-        while content_length is None or content_length > 0:
-            chunk = sock.recv(self.recv_sz)
-            if not chunk:
-                break
-            # print("RECV", chunk)
-            yield chunk
-            if content_length is not None:
-                content_length -= len(chunk)
+    def own_chunks(self, views, data):
+        # Avoid copying when the body chunk is the whole received buffer
+        for view in views:
+            if view.nbytes == len(data) and isinstance(data, bytes):
+                yield data
+            else:
+                yield bytes(view)
+
+    def recv_chunks(self, sock, parser, chunks):
+
+        if parser.remaining is None and parser.state == "body":
+            # Body is delimited by EOF so the connection can't be reused
+            sock.reusable = False
+
+        yield from chunks
+
+        while not parser.done:
+            data = sock.recv(self.recv_sz)
+            if not data:
+                if parser.eof():
+                    break
+                raise ConnectionClosedError("Connection closed before end of response")
+            yield from self.own_chunks(parser.feed(data), data)
+
+        sock.unrecv(parser.tail)
+
+    def recv_body(self, sock, parser, chunks):
+
+        if parser.state == "body" and parser.remaining is not None:
+            # Content-Length is known so receive straight into the result
+            pos = sum(len(chunk) for chunk in chunks)
+            bfr = bytearray(pos + parser.remaining)
+            view = memoryview(bfr)
+            bfr[:pos] = b"".join(chunks)
+            while pos < len(bfr):
+                n = sock.recv_into(view[pos:])
+                if not n:
+                    raise ConnectionClosedError("Connection closed before end of response")
+                pos += n
+                parser.remaining -= n
+            parser.next_state("done")
+            return bfr
+
+        if parser.remaining is None and parser.state == "body":
+            sock.reusable = False
+
+        bfr = bytearray(b"".join(chunks))
+        for view in self.recv_views(sock, parser):
+            bfr += view
+        return bfr
+
+    def recv_views(self, sock, parser):
+        # Body bytes as views of the connection's scratch buffer, each one
+        # is only valid until the next is produced
+        size = self.recv_sz
+
+        while not parser.done:
+            scratch = sock.buffer(size)
+            n = sock.recv_into(scratch)
+            if not n:
+                if parser.eof():
+                    break
+                raise ConnectionClosedError("Connection closed before end of response")
+            yield from parser.feed(scratch, 0, n)
+            if n == len(scratch) and size < self.max_recv_sz:
+                # Large response, fewer and bigger reads
+                size = min(size * 2, self.max_recv_sz)
+
+        sock.unrecv(parser.tail)
+
+    def recv_to_file(self, sock, parser, chunks, fp):
+
+        size = 0
+        for chunk in chunks:
+            fp.write(chunk)
+            size += len(chunk)
+
+        if parser.state == "body" and parser.remaining is not None:
+            if sock.pending:
+                chunk = sock.recv(parser.remaining)
+                fp.write(chunk)
+                size += len(chunk)
+                parser.remaining -= len(chunk)
+            fd = file_fileno(fp)
+            if parser.remaining and SPLICE_SUPPORT and fd is not None and sock.deadline is None and spliceable(fd):
+                size += self.splice_to_file(sock, parser, fp, fd)
+                if not parser.remaining:
+                    parser.next_state("done")
+                    return size
+        elif parser.remaining is None and parser.state == "body":
+            sock.reusable = False
+
+        for view in self.recv_views(sock, parser):
+            fp.write(view)
+            size += len(view)
+
+        return size
+
+    def splice_to_file(self, sock, parser, fp, fd):
+        # Move the body socket -> pipe -> file without copying it through
+        # user space. The pipe is needed because splice requires one end
+        # to be a pipe. If the file refuses splice, what is in the pipe is
+        # written normally and the rest of the body is left to the caller.
+        fp.flush()
+        size = 0
+        r, w = os.pipe()
+        try:
+            while parser.remaining:
+                n = os.splice(sock.fileno(), w, min(parser.remaining, SPLICE_SZ))
+                if not n:
+                    raise ConnectionClosedError("Connection closed before end of response")
+                sock.bytes_recv += n
+                parser.remaining -= n
+                size += n
+                while n:
+                    try:
+                        n -= os.splice(r, fd, n)
+                    except OSError as e:
+                        if e.errno not in (errno.EINVAL, errno.ESPIPE):
+                            raise
+                        self.sync_file(fp, fd)
+                        while n:
+                            chunk = os.read(r, n)
+                            fp.write(chunk)
+                            n -= len(chunk)
+                        return size
+            self.sync_file(fp, fd)
+        finally:
+            os.close(r)
+            os.close(w)
+        return size
+
+    def sync_file(self, fp, fd):
+        # splice moved the descriptor's offset behind the file object's back
+        if fp.seekable():
+            fp.seek(os.lseek(fd, 0, os.SEEK_CUR))
 
     def send_chunks(self, sock, chunks):
-        bfr = bytearray()
+        sent = sock.bytes_sent
+        try:
+            self._send_chunks(sock, chunks)
+        except RequestTimeoutError:
+            # Part of the request went out, the rest never will
+            if sock.bytes_sent != sent:
+                sock.reusable = False
+            raise
+
+    def _send_chunks(self, sock, chunks):
+        pending = deque()
+        size = 0
         for chunk in chunks:
-            bfr += chunk
-            while len(bfr) >= self.recv_sz:
-                # print(bfr[:self.recv_sz])
-                sock.sendall(bfr[:self.recv_sz])
-                # print("SEND", bfr)
-                bfr = bfr[self.recv_sz:]
-        if len(bfr):
-            # print(bfr)
-            # print("SEND", bfr)
-            sock.sendall(bfr)
-
-    def _request_connected(self, sock, req_chunks, headers=None):
-        self.send_chunks(sock, req_chunks)
-        header = self.request_header(sock)
-        status, reason, headers, chunk = header
-        # print(chunk)
-        yield status, reason, headers
-        for chunk in self.recv_chunks(sock, chunk, headers):
-            # print(chunk)
-            yield chunk
-
-    def _request(self, endpoint, method, headers=None, body=None, content_type=None, params=None, content_length=None):
-
-        if params is not None:
-            endpoint=f"{endpoint}?{urlencode(params)}"
+            if isinstance(chunk, FileRange):
+                while size:
+                    size -= self.send_pending(sock, pending, size)
+                if chunk.count:
+                    sock.sendfile(chunk)
+                continue
+            if not len(chunk):
+                continue
+            pending.append(memoryview(chunk))
+            size += len(chunk)
+            while size >= self.send_sz:
+                size -= self.send_pending(sock, pending, self.send_sz)
+        while size:
+            size -= self.send_pending(sock, pending, size)
+
+    def send_pending(self, sock, pending, limit):
+        # Gather up to limit bytes from the front of pending into one
+        # sendmsg call and advance past whatever the kernel accepted
+        bufs = []
+        total = 0
+        for view in pending:
+            if total >= limit or len(bufs) >= IOV_MAX:
+                break
+            view = view[:limit - total]
+            bufs.append(view)
+            total += len(view)
+        sent = n = sock.sendmsg(bufs)
+        while n:
+            view = pending[0]
+            if len(view) <= n:
+                n -= len(view)
+                pending.popleft()
+            else:
+                pending[0] = view[n:]
+                n = 0
+        return sent
 
-        if headers is None:
-            headers = ""
-        else:
-            headers = "\r\n" + "\r\n".join(f"{k}: {v}" for k, v in headers.items())
+    def _request_connected(self, sock, req_chunks, headers=None, deadline=None):
+        sock.requests += 1
+        sock.deadline = deadline
+        self.send_chunks(sock, req_chunks)
+        parser = HttpParser()
+        try:
+            chunks = self.request_header(sock, parser)
+            if parser.headers.get("Connection", "").lower() == "close":
+                sock.reusable = False
+            if self.failures:
+                # Answered, so a respawned process is healthy
+                with self.respawn_lock:
+                    self.failures = 0
+                    self.opened = None
+            try:
+                target = yield parser.status, parser.reason, parser.headers
+                if target is True:
+                    yield self.recv_body(sock, parser, chunks)
+                elif target is not None:
+                    yield self.recv_to_file(sock, parser, chunks, target)
+                else:
+                    yield from self.recv_chunks(sock, parser, chunks)
+            except GeneratorExit:
+                # The caller stopped reading early. A pooled connection is just
+                # dropped, the shared socketpair has to skip the rest of the body.
+                if sock is self.conn and not parser.done and sock.reusable:
+                    for _ in self.recv_views(sock, parser):
+                        pass
+                raise
+        except (HttpParseError, *SERVER_ERRORS):
+            # The stream itself is broken
+            sock.reusable = False
+            raise
+        except Exception:
+            # Anything else, a timeout or the destination failing, leaves
+            # the rest of the response to be skipped before the next request
+            if sock is self.conn and not parser.done:
+                sock.late.append(parser)
+            raise
+        finally:
+            sock.clear_deadline()
+        sock.last_used = time.monotonic()
+
+    def _request_pooled(self, req_chunks, replay, deadline=None, priority="interactive"):
+
+        conn = self.pool.acquire(deadline, priority)
+        reused = conn.requests > 0
+        done = False
+
+        try:
+            chunks = self._request_connected(conn, req_chunks(), None, deadline)
+            try:
+                header = next(chunks)
+            except (ConnectionClosedError, BrokenPipeError, ConnectionResetError):
+                # bw serve closed an idle keep-alive connection under us
+                if not (reused and replay):
+                    raise
+                self.pool.release(conn, reuse=False)
+                conn = None
+                conn = self.pool.acquire(deadline, priority)
+                chunks = self._request_connected(conn, req_chunks(), None, deadline)
+                header = next(chunks)
+            target = yield header
+            if target is not None:
+                yield chunks.send(target)
+            yield from chunks
+            done = True
+        finally:
+            if conn is not None:
+                self.pool.release(conn, reuse=done)
+
+    def _request_pipelined(self, conn, reqs, depth, deadline=None):
+        reqs = iter(reqs)
+        inflight = 0
+        parser = None
+        conn.deadline = deadline
+        try:
+            while True:
+                for req_chunks in itertools.islice(reqs, depth - inflight):
+                    conn.requests += 1
+                    self.send_chunks(conn, req_chunks)
+                    inflight += 1
+                if inflight == 0:
+                    return
+                parser = HttpParser()
+                body = self.recv_body(conn, parser, self.request_header(conn, parser))
+                inflight -= 1
+                resp = HttpResponse(parser.status, parser.reason, parser.headers, (body,))
+                parser = None
+                yield resp
+        except RequestTimeoutError:
+            # Responses to requests sent whole are read off the socketpair
+            # before its next request, starting with the one cut off
+            if conn is self.conn and conn.reusable and inflight:
+                conn.late += [parser or HttpParser(), *(HttpParser() for _ in range(inflight - 1))]
+            inflight = 0
+            raise
+        finally:
+            # Keep the stream in sync if the caller stops early
+            while inflight and conn.reusable:
+                parser = HttpParser()
+                self.recv_body(conn, parser, self.request_header(conn, parser))
+                inflight -= 1
+            conn.clear_deadline()
+            conn.last_used = time.monotonic()
+
+    def request_head(self, endpoint, method, headers=None, content_type=None, params=None, content_length=None):
+        keep_alive = self.socks is not None or self.pool is not None
+        return request_head(endpoint, method, headers, content_type, params, content_length, keep_alive)
+
+    def deadline(self, timeout=None):
+        if timeout is None:
+            timeout = self.timeout
+        return None if timeout is None else time.monotonic() + timeout
+
+    def skip_late(self, conn, deadline):
+        # Responses to requests that timed out are read and dropped, under
+        # the deadline of the request waiting to go next
+        conn.deadline = deadline
+        try:
+            while conn.late:
+                for _ in self.recv_views(conn, conn.late[0]):
+                    pass
+                conn.late.pop(0)
+        finally:
+            conn.clear_deadline()
 
-        req_chunks = [
-            f"{method} {endpoint} HTTP/1.1",
-            "Host: localhost"
-        ]
+    def recycle(self):
+        # The socketpair is out of step, e.g. a request was cut off while it
+        # was being sent. Only a supervised server replaces bw serve for it.
+        if not (self.serve and self.supervise):
+            raise ConnectionClosedError("Connection to bw serve is out of step")
+        self.respawn(self.proc, failed=False)
 
-        if self.socks is None:
-            req_chunks.append("Connection: disconnect")
-        else:
-            req_chunks.append("Connection: keep-alive")
+    def lane(self, default="interactive"):
+        # The priority set by VaultServer.priority() wins over a method's default
+        return PRIORITY.get() or default
 
-        if method in ("POST", "PUT"):
+    def _request(self, endpoint, method, headers=None, body=None, content_type=None, params=None, content_length=None, timeout=None, priority=None):
 
-            if content_length is not None:
-                content_length = str(content_length)
-            else:
-                content_length = "0"
+        deadline = self.deadline(timeout)
+        if priority is None:
+            priority = self.lane()
+        assert priority in PRIORITIES
 
-            req_chunks.append(f"Content-Length: {content_length}")
+        head = self.request_head(endpoint, method, headers, content_type, params, content_length)
 
-            if content_type:
-                req_chunks.append(f"Content-Type: {content_type}")
+        if body is None:
+            body = ()
 
-        req_chunks = (("\r\n".join(req_chunks) + "\r\n\r\n").encode("utf-8"),)
+        req_chunks = lambda: itertools.chain((head,), body)
 
-        if body is not None:
-            req_chunks = itertools.chain(req_chunks, body)
+        # Only an idempotent request with a body that can be sent again is
+        # replayed on a fresh connection
+        replay = method in IDEMPOTENT_METHODS and isinstance(body, (tuple, list))
+        attempt = lambda: self._request_attempt(req_chunks, replay, headers, deadline, priority)
 
-        if self.socks is None:
-            with self.connect_socket() as sock:
-                for chunk in self._request_connected(sock, req_chunks, headers):
-                    yield chunk
+        if self.supervise:
+            yield from self._request_supervised(method, attempt)
+        else:
+            yield from attempt()
+
+    def _request_attempt(self, req_chunks, replay, headers, deadline, priority="interactive"):
+        if self.pool is not None:
+            yield from self._request_pooled(req_chunks, replay, deadline, priority)
+        elif self.socks is None:
+            with self.connect_socket(remaining(deadline)) as sock:
+                yield from self._request_connected(Connection(sock), req_chunks(), headers, deadline)
+        else:
+            with self.shared_conn(deadline, priority) as conn:
+                yield from self._request_connected(conn, req_chunks(), headers, deadline)
+
+    @contextmanager
+    def shared_conn(self, deadline=None, priority="interactive"):
+
+        # The socketpair carries one request and response at a time. The
+        # lock is held until the response has been read, so a thread that
+        # sends again before reading would wait on itself.
+
+        if self.conn_owner == threading.get_ident():
+            raise RuntimeError("Read the previous response before sending another request from this thread")
+
+        if not self.conn_lock.acquire(priority, remaining(deadline)):
+            raise RequestTimeoutError("Timed out waiting for the shared connection")
+
+        try:
+            self.conn_owner = threading.get_ident()
+            if self.conn.late and self.conn.reusable:
+                self.skip_late(self.conn, deadline)
+            if not self.conn.reusable:
+                self.recycle()
+            yield self.conn
+        finally:
+            self.conn_owner = None
+            self.conn_lock.release()
+
+    def stats(self):
+        if self.pool is not None:
+            stats = self.pool.stats()
+        elif self.conn is not None:
+            stats = self.conn.stats()
         else:
-            sock = self.socks[0]
-            for chunk in self._request_connected(sock, req_chunks, headers):
-                yield chunk
-            # self.send_chunks(sock, req_chunks)
-            # header = self.request_header(sock)
-            # status, reason, headers, chunk = header
-            # # print(chunk)
-            # yield status, reason, headers
-            # for chunk in self.recv_chunks(sock, chunk, headers):
-            #     # print(chunk)
-            #     yield chunk
-
-    def request(self, endpoint, method, headers=None, body=None, content_type=None, params=None, content_length=None):
-        chunks = self._request(endpoint, method, headers, body, content_type, params, content_length)
+            return None
+        if self.supervise:
+            stats = dict(stats, respawns=self.respawns, failures=self.failures, open=self.opened is not None)
+        return stats
+
+    def request(self, endpoint, method, headers=None, body=None, content_type=None, params=None, content_length=None, timeout=None, priority=None):
+        chunks = self._request(endpoint, method, headers, body, content_type, params, content_length, timeout, priority)
         status, reason, headers = next(chunks)
         return HttpResponse(status, reason, headers, chunks)
 
-    def request_bytes(self, endpoint, method, headers=None, value=None, params=None):
-        if value is None:
-            body = None
-            content_length = None
-        else:
-            value = json.dumps(value).encode()
-            body = (value,)
-            content_length = len(value)
+    def json_body(self, value):
+        return json_body(value)
+
+    def request_bytes(self, endpoint, method, headers=None, value=None, params=None, timeout=None, priority=None):
+        body, content_length = self.json_body(value)
         content_type="application/json"
-        resp = self.request(endpoint, method, headers, body, content_type, params, content_length)
+        resp = self.request(endpoint, method, headers, body, content_type, params, content_length, timeout, priority)
         return resp.bytes(check=True)
 
-    def request_text(self, endpoint, method, headers=None, value=None, params=None):
-        chunks = self.request_bytes(endpoint, method, headers, value, params)
+    def request_chunks(self, endpoint, method, headers=None, value=None, params=None, timeout=None, priority=None):
+        body, content_length = self.json_body(value)
+        resp = self.request(endpoint, method, headers, body, "application/json", params, content_length, timeout, priority)
+        resp.check()
+        yield from resp.chunks
+
+    def request_json_items(self, endpoint, method, path, headers=None, value=None, params=None, timeout=None, priority=None):
+        body, content_length = self.json_body(value)
+        resp = self.request(endpoint, method, headers, body, "application/json", params, content_length, timeout, priority)
+        resp.check()
+        yield from iter_json_items(resp.chunks, path)
+
+    def request_download(self, endpoint, method, dest, headers=None, value=None, params=None, timeout=None, priority=None):
+        body, content_length = self.json_body(value)
+        resp = self.request(endpoint, method, headers, body, "application/json", params, content_length, timeout, priority)
+        return resp.save(dest, check=True)
+
+    def request_text(self, endpoint, method, headers=None, value=None, params=None, timeout=None, priority=None):
+        chunks = self.request_bytes(endpoint, method, headers, value, params, timeout, priority)
         return chunks.decode()
 
-    def request_json(self, endpoint, method, headers=None, value=None, params=None, text=False):
-        text = self.request_text(endpoint, method, headers, value, params)
-        return json.loads(text)
+    def request_json(self, endpoint, method, headers=None, value=None, params=None, text=False, timeout=None, priority=None):
+        body, content_length = self.json_body(value)
+        resp = self.request(endpoint, method, headers, body, "application/json", params, content_length, timeout, priority)
+        return resp.json(check=True)
 
-    def file_pre_body(self, fpath, boundary):
-        filename = encode_rfc2231(os.path.basename(fpath))
-        mime_type, _ = mimetypes.guess_type(fpath) or "application/octet-stream"
-        mime_type = mime_type or "application/octet-stream"
-        field_name = "file"
+    def request_many(self, requests, depth=32, timeout=None, priority=None):
+        # Each request is a dict of request_bytes arguments. Requests are
+        # written back to back on one connection and the responses are
+        # yielded in order.
+
+        def encode(endpoint, method, headers=None, value=None, params=None):
+            body, content_length = self.json_body(value)
+            head = self.request_head(endpoint, method, headers, "application/json", params, content_length)
+            return itertools.chain((head,), body or ())
+
+        reqs = (encode(**req) for req in requests)
+        deadline = self.deadline(timeout)
+        if priority is None:
+            priority = self.lane()
+
+        if self.supervise:
+            self.ensure_serving()
+
+        if self.pool is not None or self.socks is not None:
+            # Each window is read in full and the connection given back
+            # before its responses are yielded, so the caller can make other
+            # requests while iterating and waiting interactive requests get
+            # the socketpair between windows
+            while window := list(itertools.islice(reqs, depth)):
+                yield from self._request_window(window, depth, deadline, priority)
+        else:
+            for req in requests:
+                body, content_length = self.json_body(req.get("value"))
+                chunks = self._request(req["endpoint"], req["method"], req.get("headers"), body, "application/json", req.get("params"), content_length, remaining(deadline), priority)
+                status, reason, headers = next(chunks)
+                yield HttpResponse(status, reason, headers, (b"".join(chunks),))
+
+    def _request_window(self, window, depth, deadline, priority):
+        if self.pool is None:
+            with self.shared_conn(deadline, priority) as conn:
+                return list(self._request_pipelined(conn, window, depth, deadline))
+        conn = self.pool.acquire(deadline, priority)
+        done = False
+        try:
+            resps = list(self._request_pipelined(conn, window, depth, deadline))
+            done = True
+        finally:
+            self.pool.release(conn, reuse=done)
+        return resps
+
+    def request_json_many(self, requests, depth=32, timeout=None, priority=None):
+        for resp in self.request_many(requests, depth, timeout, priority):
+            yield resp.json(check=True)
 
-        return ("\r\n".join((
-            f"--{boundary}",
-            f'Content-Disposition: form-data; name="{field_name}"; filename*={filename}',
-            f"Content-Type: {mime_type}",
-        )) + "\r\n\r\n").encode()
+    def file_pre_body(self, fpath, boundary):
+        return file_pre_body(fpath, boundary)
 
     def file_post_body(self, boundary):
-        return f"\r\n--{boundary}--\r\n".encode()
+        return file_post_body(boundary)
 
-    def file_chunks(self, fpath, pre_body, post_body, file_size):
+    def request_file(self, endpoint, method, headers=None, fpath=None, params=None, timeout=None, priority=None):
 
-        yield pre_body
+        boundary=FORM_BOUNDARY
+        content_type=f"multipart/form-data; boundary={boundary}"
 
-        with open(fpath, "rb") as fp:
+        if fpath is None:
+            resp = self.request(endpoint, method, headers, None, content_type, params, 0, timeout, priority)
+            return resp.json(check=True)
 
-            while file_size:
+        pre_body = self.file_pre_body(fpath, boundary)
+        post_body = self.file_post_body(boundary)
 
-                ed = min(file_size, self.send_sz)
-                file_size -= ed
-                yield fp.read(ed)
+        with open(fpath, "rb") as fp:
+            file_size = os.fstat(fp.fileno()).st_size
+            # The file contents go from the descriptor to the socket in the kernel
+            body = (pre_body, FileRange(fp, 0, file_size), post_body)
+            content_length = len(pre_body) + file_size + len(post_body)
+            resp = self.request(endpoint, method, headers, body, content_type, params, content_length, timeout, priority)
+            return resp.json(check=True)
 
-        yield post_body
+class Standby:
 
-    def request_file(self, endpoint, method, headers=None, fpath=None, params=None):
+    # Keeps spare socketpair bw serve processes spawned and warmed up so a
+    # new Server can take one over instead of paying the cold start.
 
-        boundary="----PyFormBoundary"
-        content_type=f"multipart/form-data; boundary={boundary}"
+    def __init__(self, spares=1, bw_path=None, env=None, timeout=30):
+        self.spares = spares
+        self.bw_path = bw_path
+        self.env = env
+        self.timeout = timeout
+        self.ready = deque()
+        self.spawning = 0
+        self.closed = False
+        self.cond = threading.Condition()
+        self.fill()
 
-        if fpath is None:
-            body = None
-            content_length = 0
-        else:
-            pre_body = self.file_pre_body(fpath, boundary)
-            post_body = self.file_post_body(boundary)
-            file_size = os.path.getsize(fpath)
-            body = self.file_chunks(fpath, pre_body, post_body, file_size)
-            content_length = len(pre_body) + file_size + len(post_body)
+    def __enter__(self):
+        return self
 
-        resp = self.request(endpoint, method, headers, body, content_type, params, content_length)
-        return resp.json(check=True)
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def fill(self):
+        with self.cond:
+            while not self.closed and len(self.ready) + self.spawning < self.spares:
+                self.spawning += 1
+                threading.Thread(target=self.spawn, daemon=True).start()
+
+    def spawn(self):
+        socks = socket.socketpair()
+        proc = None
+        try:
+            kwds = {} if self.env is None else dict(env=self.env)
+            proc = bw_serve(socks, bw_path=self.bw_path, **kwds)
+            socks[1].close()
+            # The first response means node has finished loading
+            Server(socks=socks, serve=False, wait=False).request_json("/status", "GET", timeout=self.timeout)
+        except Exception:
+            self.discard(socks, proc)
+            socks = None
+        with self.cond:
+            self.spawning -= 1
+            if socks is not None and self.closed:
+                self.discard(socks, proc)
+            elif socks is not None:
+                self.ready.append((socks, proc))
+            self.cond.notify_all()
+
+    def discard(self, socks, proc):
+        if proc is not None:
+            proc.terminate()
+            proc.wait()
+        for sock in socks:
+            sock.close()
+
+    def take(self):
+        # Waits for a spare that is still starting, otherwise the caller
+        # falls back to a cold start
+        with self.cond:
+            self.cond.wait_for(lambda: self.ready or not self.spawning, self.timeout)
+            while self.ready:
+                socks, proc = self.ready.popleft()
+                if proc.poll() is None:
+                    break
+                self.discard(socks, proc)
+            else:
+                socks, proc = None, None
+        self.fill()
+        return socks, proc
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            ready, self.ready = list(self.ready), deque()
+        for socks, proc in ready:
+            self.discard(socks, proc)
+
+    def stats(self):
+        with self.cond:
+            return dict(ready=len(self.ready), spawning=self.spawning)
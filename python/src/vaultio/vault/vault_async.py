@@ -0,0 +1,182 @@
+# This file is part of vaultio.
+#
+# vaultio is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# vaultio is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with vaultio.  If not, see <https://www.gnu.org/licenses/>.
+
+from ..util import password_input, remove_none
+from .async_server import AsyncServer
+from .vault_server import VaultServer
+
+class AsyncVaultServer:
+
+    def __init__(self, socks=None, host=None, port=None, sock_path=None, serve=True, wait=True, bw_path=None, allow_write=True, pool_size=8) -> None:
+        self._server = AsyncServer(socks=socks, host=host, port=port, sock_path=sock_path, serve=serve, wait=wait, bw_path=bw_path, pool_size=pool_size)
+        self.allow_write = allow_write
+
+    async def __aenter__(self):
+        await self._server.start()
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self._server.end()
+
+    async def serve(self):
+        await self._server.serve_socket()
+        await self._server.wait_socket()
+
+    async def close(self):
+        await self._server.end()
+
+    async def lock(self):
+        value = await self._server.request_json("/lock", "POST")
+        return value["success"]
+
+    async def unlock(self, password=None):
+        if password is None:
+            password = password_input()
+        value = await self._server.request_json("/unlock", "POST", value={"password": password})
+        return value["data"]["raw"] if value["success"] else None
+
+    async def sync(self):
+        value = await self._server.request_json("/sync", "POST")
+        return value["success"]
+
+    async def status(self):
+        value = await self._server.request_json("/status", "GET")
+        return value["data"]["template"] if value["success"] else None
+
+    async def generate(self, length=None, uppercase=None, lowercase=None, numbers=None, special=None, passphrase=None, words=None, seperator=None, capitalize=None, include_number=None):
+
+        params = remove_none(dict(length=length, uppercase=uppercase, lowercase=lowercase, number=numbers, special=special, passphrase=passphrase, words=words, seperator=seperator, capitalize=capitalize, includeNumber=include_number))
+
+        value = await self._server.request_json("/generate", "GET", params=params)
+
+        return value["data"]["data"] if value["success"] else None
+
+    async def fingerprint(self):
+        value = await self._server.request_json("/object/fingerprint/me", "GET")
+        return value["data"] if value["success"] else None
+
+    async def template(self, type):
+        value = await self._server.request_json(f"/object/template/{type}", "GET")
+        return value["data"]["template"] if value["success"] else None
+
+    async def get_attachment(self, attachment_id, item_id, dest=None):
+        params = dict(itemid=item_id)
+        if dest is not None:
+            return await self._server.request_download(f"/object/attachment/{attachment_id}", "GET", dest, params=params)
+        value = await self._server.request_bytes(f"/object/attachment/{attachment_id}", "GET", params=params)
+        return value
+
+    async def iter_attachment(self, attachment_id, item_id):
+        params = dict(itemid=item_id)
+        async for chunk in self._server.request_chunks(f"/object/attachment/{attachment_id}", "GET", params=params):
+            yield chunk
+
+    async def new_attachment(self, uuid, fpath=None):
+        assert self.allow_write
+        params = dict(itemid=uuid)
+        value = await self._server.request_file("/attachment", "POST", fpath=fpath, params=params)
+        return value["data"] if value["success"] else None
+
+    GET_TYPES = VaultServer.GET_TYPES
+
+    async def get(self, uuid, type="item"):
+        assert type in self.GET_TYPES
+        value = await self._server.request_json(f"/object/{type}/{uuid}", "GET")
+        return value["data"] if value["success"] else None
+
+    async def get_many(self, uuids, type="item", limit=32):
+        assert type in self.GET_TYPES
+        requests = [dict(endpoint=f"/object/{type}/{uuid}", method="GET") for uuid in uuids]
+        return [
+            value["data"] if value["success"] else None
+            for value in await self._server.request_json_many(requests, limit)
+        ]
+
+    NEW_TYPES = VaultServer.NEW_TYPES
+
+    async def new(self, value, type="item"):
+        assert type in self.NEW_TYPES
+        assert self.allow_write
+        value = await self._server.request_json(f"/object/{type}", "POST", value=value)
+        return value["data"] if value["success"] else None
+
+    EDIT_TYPES = VaultServer.EDIT_TYPES
+
+    async def edit(self, value, type="item"):
+        assert type in self.EDIT_TYPES
+        assert self.allow_write
+        uuid = value["uuid"]
+        value = await self._server.request_json(f"/object/{type}/{uuid}", "PUT", value=value)
+        return value["data"] if value["success"] else None
+
+    DELETE_TYPES = VaultServer.DELETE_TYPES
+
+    async def delete(self, uuid, type="item"):
+        assert self.allow_write
+        value = await self._server.request_json(f"/object/{type}/{uuid}", "DELETE")
+        return value["success"]
+
+    RESTORE_TYPES = VaultServer.RESTORE_TYPES
+
+    async def restore(self, uuid):
+        assert self.allow_write
+        value = await self._server.request_json(f"/restore/item/{uuid}", "POST")
+        return value["success"]
+
+    LIST_TYPES = VaultServer.LIST_TYPES
+
+    list_request = VaultServer.list_request
+
+    async def list(self, organization_id=None, collection_id=None, folder_id=None, url=None, trash=None, search=None, type="item"):
+        endpoint, params = self.list_request(organization_id, collection_id, folder_id, url, trash, search, type)
+        value = await self._server.request_json(endpoint, "GET", params=params)
+        return value["data"]["data"] if value["success"] else None
+
+    async def iter_list(self, organization_id=None, collection_id=None, folder_id=None, url=None, trash=None, search=None, type="item"):
+        endpoint, params = self.list_request(organization_id, collection_id, folder_id, url, trash, search, type)
+        async for item in self._server.request_json_items(endpoint, "GET", ("data", "data"), params=params):
+            yield item
+
+    async def confirm(self, uuid, organization_id):
+        assert self.allow_write
+        params = dict(organizationId=organization_id)
+        value = await self._server.request_json(f"/confirm/org-member/{uuid}", "POST", params=params)
+        return value["success"]
+
+    async def move(self, item_id, organization_id, collection_ids):
+        assert self.allow_write
+        value = await self._server.request_json(f"/move/{item_id}/{organization_id}", "POST", value=collection_ids)
+        return value
+
+    async def pending(self, organization_id):
+        assert self.allow_write
+        value = await self._server.request_json(f"/device-approval/{organization_id}", "GET")
+        return value
+
+    async def trust(self, organization_id, request_id=None):
+        assert self.allow_write
+        if request_id is None:
+            value = await self._server.request_json(f"/device-approval/{organization_id}/approve-all", "POST")
+        else:
+            value = await self._server.request_json(f"/device-approval/{organization_id}/approve/{request_id}", "POST")
+        return value["success"]
+
+    async def deny(self, organization_id, request_id=None):
+        assert self.allow_write
+        if request_id is None:
+            value = await self._server.request_json(f"/deny-approval/{organization_id}/deny-all", "GET")
+        else:
+            value = await self._server.request_json(f"/device-approval/{organization_id}/deny/{request_id}", "POST")
+        return value["success"]
@@ -0,0 +1,225 @@
+# This file is part of vaultio.
+#
+# vaultio is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# vaultio is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with vaultio.  If not, see <https://www.gnu.org/licenses/>.
+
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+import os
+from pathlib import Path
+import shutil
+import socket
+import tempfile
+import threading
+
+from ..util import bw_appdata_dir, password_input
+from .vault_server import VaultServer
+
+class VaultServerPool:
+
+    # Several bw serve processes behind one VaultServer interface. Reads go
+    # to the least loaded worker, writes go to the first worker one at a
+    # time and are followed by a sync of the others.
+
+    def __init__(self, workers=4, bw_path=None, allow_write=True, appdata_dir=None, source_dir=None) -> None:
+
+        if appdata_dir is not None:
+            os.makedirs(appdata_dir, exist_ok=True)
+
+        if source_dir is None:
+            source_dir = bw_appdata_dir()
+
+        self.allow_write = allow_write
+        self.workers = []
+        # The copies of the account state belong to this pool only and are
+        # removed on close, appdata_dir is just where they are created
+        self.appdata_dir = Path(tempfile.mkdtemp(prefix="vaultio-pool-", dir=appdata_dir))
+
+        try:
+            for i in range(workers):
+                worker_dir = self.appdata_dir / f"worker{i}"
+                self.seed_appdata(Path(source_dir), worker_dir)
+                env = dict(os.environ, BITWARDENCLI_APPDATA_DIR=str(worker_dir))
+                self.workers.append(VaultServer(socks=socket.socketpair(), bw_path=bw_path, allow_write=allow_write, env=env))
+        except BaseException:
+            self.close()
+            raise
+
+        self.load = [0] * len(self.workers)
+        self.load_lock = threading.Lock()
+        self.write_lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(len(self.workers))
+
+    def seed_appdata(self, source_dir, worker_dir):
+        # Each worker needs its own copy of the logged in account state
+        worker_dir.mkdir(mode=0o700)
+        source = source_dir / "data.json"
+        if source.exists():
+            shutil.copy2(source, worker_dir / "data.json")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        for worker in self.workers:
+            worker.close()
+        if hasattr(self, "executor"):
+            self.executor.shutdown()
+        shutil.rmtree(self.appdata_dir, ignore_errors=True)
+
+    @contextmanager
+    def reader(self):
+        with self.load_lock:
+            i = min(range(len(self.workers)), key=self.load.__getitem__)
+            self.load[i] += 1
+        try:
+            yield self.workers[i]
+        finally:
+            with self.load_lock:
+                self.load[i] -= 1
+
+    @contextmanager
+    def writer(self):
+        assert self.allow_write
+        with self.write_lock:
+            yield self.workers[0]
+            self.fan_out(lambda worker: worker.sync(), self.workers[1:])
+
+    def fan_out(self, fn, workers=None):
+        if workers is None:
+            workers = self.workers
+        futures = [self.executor.submit(fn, worker) for worker in workers]
+        return [future.result() for future in futures]
+
+    def stats(self):
+        with self.load_lock:
+            load = list(self.load)
+        return [
+            dict(load=load[i], server=worker._server.stats())
+            for i, worker in enumerate(self.workers)
+        ]
+
+    def lock(self):
+        with self.write_lock:
+            return all(self.fan_out(lambda worker: worker.lock()))
+
+    def unlock(self, password=None):
+        # Every worker gets its own session, so there is no single one to
+        # hand back
+        if password is None:
+            password = password_input()
+        with self.write_lock:
+            return all(self.fan_out(lambda worker: worker.unlock(password)))
+
+    def sync(self):
+        with self.write_lock:
+            return all(self.fan_out(lambda worker: worker.sync()))
+
+    def status(self):
+        with self.reader() as worker:
+            return worker.status()
+
+    def generate(self, *args, **kwds):
+        with self.reader() as worker:
+            return worker.generate(*args, **kwds)
+
+    def fingerprint(self):
+        with self.reader() as worker:
+            return worker.fingerprint()
+
+    def template(self, type):
+        with self.reader() as worker:
+            return worker.template(type)
+
+    def get_attachment(self, attachment_id, item_id, dest=None):
+        with self.reader() as worker:
+            return worker.get_attachment(attachment_id, item_id, dest)
+
+    def iter_attachment(self, attachment_id, item_id):
+        with self.reader() as worker:
+            yield from worker.iter_attachment(attachment_id, item_id)
+
+    def new_attachment(self, uuid, fpath=None):
+        with self.writer() as worker:
+            return worker.new_attachment(uuid, fpath)
+
+    def get(self, uuid, type="item"):
+        with self.reader() as worker:
+            return worker.get(uuid, type)
+
+    def get_many(self, uuids, type="item", depth=32):
+        with self.reader() as worker:
+            return worker.get_many(uuids, type, depth)
+
+    def iter_get_many(self, uuids, type="item", depth=32):
+        with self.reader() as worker:
+            yield from worker.iter_get_many(uuids, type, depth)
+
+    def new_many(self, values, type="item", depth=32):
+        with self.writer() as worker:
+            yield from worker.new_many(values, type, depth)
+
+    def edit_many(self, values, type="item", depth=32):
+        with self.writer() as worker:
+            yield from worker.edit_many(values, type, depth)
+
+    def delete_many(self, uuids, type="item", depth=32):
+        with self.writer() as worker:
+            yield from worker.delete_many(uuids, type, depth)
+
+    def new(self, value, type="item"):
+        with self.writer() as worker:
+            return worker.new(value, type)
+
+    def edit(self, value, type="item"):
+        with self.writer() as worker:
+            return worker.edit(value, type)
+
+    def delete(self, uuid, type="item"):
+        with self.writer() as worker:
+            return worker.delete(uuid, type)
+
+    def restore(self, uuid):
+        with self.writer() as worker:
+            return worker.restore(uuid)
+
+    def list(self, *args, **kwds):
+        with self.reader() as worker:
+            return worker.list(*args, **kwds)
+
+    def iter_list(self, *args, **kwds):
+        with self.reader() as worker:
+            yield from worker.iter_list(*args, **kwds)
+
+    def confirm(self, uuid, organization_id):
+        with self.writer() as worker:
+            return worker.confirm(uuid, organization_id)
+
+    def move(self, item_id, organization_id, collection_ids):
+        with self.writer() as worker:
+            return worker.move(item_id, organization_id, collection_ids)
+
+    def pending(self, organization_id):
+        with self.reader() as worker:
+            return worker.pending(organization_id)
+
+    def trust(self, organization_id, request_id=None):
+        with self.writer() as worker:
+            return worker.trust(organization_id, request_id)
+
+    def deny(self, organization_id, request_id=None):
+        with self.writer() as worker:
+            return worker.deny(organization_id, request_id)
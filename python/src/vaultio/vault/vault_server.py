@@ -13,14 +13,33 @@
 # You should have received a copy of the GNU General Public License
 # along with vaultio.  If not, see <https://www.gnu.org/licenses/>.
 
+from collections import deque
+from contextlib import contextmanager
+import itertools
+import json
+
 from ..util import password_input, remove_none
-from .server import Server
+from .cache import ResponseCache, SingleFlight, request_key
+from .server import PRIORITY, HttpResponseError, Server
+
+# Responses that change from one moment to the next are never cached or
+# shared between callers
+LIVE_TYPES = {"totp", "exposed"}
+LIVE_ENDPOINTS = ("/status", *(f"/object/{type}/" for type in LIVE_TYPES))
 
 class VaultServer:
 
-    def __init__(self, socks=None, host=None, port=None, sock_path=None, fd=None, serve=True, wait=True, bw_path=None, allow_write=True) -> None:
-        self._server = Server(socks=socks, host=host, port=port, sock_path=sock_path, fd=fd, serve=serve, wait=wait, bw_path=bw_path)
+    def __init__(self, socks=None, host=None, port=None, sock_path=None, fd=None, serve=True, wait=True, bw_path=None, allow_write=True, pool_size=8, env=None, standby=None, supervise=False, timeout=None, cache=None, coalesce=True) -> None:
+        self._server = Server(socks=socks, host=host, port=port, sock_path=sock_path, fd=fd, serve=serve, wait=wait, bw_path=bw_path, pool_size=pool_size, env=env, standby=standby, supervise=supervise, timeout=timeout)
         self.allow_write = allow_write
+        if cache is True:
+            cache = ResponseCache()
+        self.cache = cache
+        # Identical GETs in flight at the same time share one round trip
+        self.flights = SingleFlight() if coalesce else None
+        # Bumped by every write so reads never join a flight from before it
+        self.writes = itertools.count()
+        self.generation = next(self.writes)
 
     def __enter__(self):
         self._server.start()
@@ -36,49 +55,132 @@ class VaultServer:
     def close(self):
         self._server.end()
 
-    def lock(self):
-        value = self._server.request_json("/lock", "POST")
+    @contextmanager
+    def priority(self, priority):
+        # Requests made in this block on this thread use the given priority
+        token = PRIORITY.set(priority)
+        try:
+            yield self
+        finally:
+            PRIORITY.reset(token)
+
+    def _request_json(self, endpoint, params=None, timeout=None, priority=None):
+
+        # GET through the response cache and single flight when enabled
+
+        if (self.cache is None and self.flights is None) or endpoint.startswith(LIVE_ENDPOINTS):
+            return self._server.request_json(endpoint, "GET", params=params, timeout=timeout, priority=priority)
+
+        key = request_key(endpoint, params)
+
+        if self.cache is not None:
+            body = self.cache.get(key)
+            if body is not None:
+                return json.loads(body)
+
+        def fetch():
+            generation = None if self.cache is None else self.cache.generation
+            return generation, self._server.request_bytes(endpoint, "GET", params=params, timeout=timeout, priority=priority)
+
+        if self.flights is None:
+            generation, body = fetch()
+        else:
+            generation, body = self.flights.do((key, self.generation), fetch, self._server.timeout if timeout is None else timeout)
+
+        # Each caller decodes its own copy of a shared body
+        value = json.loads(body)
+        if self.cache is not None and value["success"]:
+            self.cache.put(key, body, generation)
+        return value
+
+    def invalidate(self, uuid=None, type="item"):
+
+        # Drops the cached objects for uuid and every cached list of type
+
+        self.generation = next(self.writes)
+
+        if self.cache is None:
+            return
+
+        lists = f"/list/object/{type.rstrip('s')}"
+        suffix = f"/{uuid}"
+
+        def match(endpoint):
+            if endpoint.startswith(lists):
+                return True
+            return uuid is not None and endpoint.startswith("/object/") and endpoint.endswith(suffix)
+
+        self.cache.invalidate(match)
+
+    def invalidate_all(self):
+        self.generation = next(self.writes)
+        if self.cache is not None:
+            self.cache.clear()
+
+    def lock(self, timeout=None):
+        try:
+            value = self._server.request_json("/lock", "POST", timeout=timeout)
+        finally:
+            self.invalidate_all()
+        if value["success"]:
+            self._server.session = None
         return value["success"]
 
-    def unlock(self, password=None):
+    def unlock(self, password=None, timeout=None):
         if password is None:
             password = password_input()
-        value = self._server.request_json("/unlock", "POST", value={"password": password})
-        return value["data"]["raw"] if value["success"] else None
-
-    def sync(self):
-        value = self._server.request_json("/sync", "POST")
+        value = self._server.request_json("/unlock", "POST", value={"password": password}, timeout=timeout)
+        if not value["success"]:
+            return None
+        # A respawned bw serve is unlocked with the same session
+        self._server.session = value["data"]["raw"]
+        return self._server.session
+
+    def sync(self, timeout=None):
+        try:
+            value = self._server.request_json("/sync", "POST", timeout=timeout)
+        finally:
+            self.invalidate_all()
         return value["success"]
 
-    def status(self):
-        value = self._server.request_json("/status", "GET")
+    def status(self, timeout=None):
+        value = self._server.request_json("/status", "GET", timeout=timeout)
         return value["data"]["template"] if value["success"] else None
 
-    def generate(self, length=None, uppercase=None, lowercase=None, numbers=None, special=None, passphrase=None, words=None, seperator=None, capitalize=None, include_number=None):
+    def generate(self, length=None, uppercase=None, lowercase=None, numbers=None, special=None, passphrase=None, words=None, seperator=None, capitalize=None, include_number=None, timeout=None):
 
         params = remove_none(dict(length=length, uppercase=uppercase, lowercase=lowercase, number=numbers, special=special, passphrase=passphrase, words=words, seperator=seperator, capitalize=capitalize, includeNumber=include_number))
 
-        value = self._server.request_json("/generate", "GET", params=params)
+        value = self._server.request_json("/generate", "GET", params=params, timeout=timeout)
 
         return value["data"]["data"] if value["success"] else None
 
-    def fingerprint(self):
-        value = self._server.request_json("/object/fingerprint/me", "GET")
+    def fingerprint(self, timeout=None):
+        value = self._request_json("/object/fingerprint/me", timeout=timeout)
         return value["data"] if value["success"] else None
 
-    def template(self, type):
-        value = self._server.request_json(f"/object/template/{type}", "GET")
+    def template(self, type, timeout=None):
+        value = self._request_json(f"/object/template/{type}", timeout=timeout)
         return value["data"]["template"] if value["success"] else None
 
-    def get_attachment(self, attachment_id, item_id):
+    def get_attachment(self, attachment_id, item_id, dest=None, timeout=None):
         params = dict(itemid=item_id)
-        value = self._server.request_bytes(f"/object/attachment/{attachment_id}", "GET", params=params)
+        if dest is not None:
+            return self._server.request_download(f"/object/attachment/{attachment_id}", "GET", dest, params=params, timeout=timeout, priority=self._server.lane("bulk"))
+        value = self._server.request_bytes(f"/object/attachment/{attachment_id}", "GET", params=params, timeout=timeout, priority=self._server.lane("bulk"))
         return value
 
-    def new_attachment(self, uuid, fpath=None):
+    def iter_attachment(self, attachment_id, item_id, timeout=None):
+        params = dict(itemid=item_id)
+        yield from self._server.request_chunks(f"/object/attachment/{attachment_id}", "GET", params=params, timeout=timeout, priority=self._server.lane("bulk"))
+
+    def new_attachment(self, uuid, fpath=None, timeout=None):
         assert self.allow_write
         params = dict(itemid=uuid)
-        value = self._server.request_file(f"/attachment", "POST", fpath=fpath, params=params)
+        try:
+            value = self._server.request_file("/attachment", "POST", fpath=fpath, params=params, timeout=timeout, priority=self._server.lane("bulk"))
+        finally:
+            self.invalidate(uuid)
         return value["data"] if value["success"] else None
 
     GET_TYPES = {
@@ -91,11 +193,65 @@ class VaultServer:
         "folder",
     }
 
-    def get(self, uuid, type="item"):
+    def get(self, uuid, type="item", timeout=None):
         assert type in self.GET_TYPES
-        value = self._server.request_json(f"/object/{type}/{uuid}", "GET")
+        value = self._request_json(f"/object/{type}/{uuid}", timeout=timeout)
         return value["data"] if value["success"] else None
 
+    def get_many(self, uuids, type="item", depth=32, timeout=None):
+        assert type in self.GET_TYPES
+
+        if self.cache is None or type in LIVE_TYPES:
+            requests = (dict(endpoint=f"/object/{type}/{uuid}", method="GET") for uuid in uuids)
+            return [
+                value["data"] if value["success"] else None
+                for value in self._server.request_json_many(requests, depth, timeout=timeout, priority=self._server.lane("bulk"))
+            ]
+
+        # Only the cache misses are pipelined to bw serve
+        keys = [self.cache.key(f"/object/{type}/{uuid}") for uuid in uuids]
+        bodies = [self.cache.get(key) for key in keys]
+        missing = [i for i, body in enumerate(bodies) if body is None]
+        generation = self.cache.generation
+        requests = (dict(endpoint=keys[i][0], method="GET") for i in missing)
+        for i, resp in zip(missing, self._server.request_many(requests, depth, timeout, self._server.lane("bulk"))):
+            bodies[i] = resp.bytes(check=True)
+        values = [json.loads(body) for body in bodies]
+        for i in missing:
+            if values[i]["success"]:
+                self.cache.put(keys[i], bodies[i], generation)
+        return [value["data"] if value["success"] else None for value in values]
+
+    def _batch(self, items, request, depth, timeout):
+
+        # Pipelines one request per item with at most depth in flight and
+        # yields (item, value, error) in order as responses arrive. Errors
+        # from bw serve are reported per item, transport errors end the batch.
+
+        sent = deque()
+
+        def requests():
+            for item in items:
+                sent.append(item)
+                yield request(item)
+
+        for resp in self._server.request_many(requests(), depth, timeout, self._server.lane("bulk")):
+            item = sent.popleft()
+            try:
+                value = resp.json(check=True)
+            except HttpResponseError as e:
+                yield item, None, e
+                continue
+            if value["success"]:
+                yield item, value.get("data"), None
+            else:
+                yield item, None, HttpResponseError(resp.status, resp.reason, resp.headers, value.get("message"))
+
+    def iter_get_many(self, uuids, type="item", depth=32, timeout=None):
+        assert type in self.GET_TYPES
+        request = lambda uuid: dict(endpoint=f"/object/{type}/{uuid}", method="GET")
+        yield from self._batch(uuids, request, depth, timeout)
+
     NEW_TYPES = {
         "item",
         "send",
@@ -103,12 +259,24 @@ class VaultServer:
         "org-collection",
     }
 
-    def new(self, value, type="item"):
+    def new(self, value, type="item", timeout=None):
         assert type in self.NEW_TYPES
         assert self.allow_write
-        value = self._server.request_json(f"/object/{type}", "GET", value=value)
+        try:
+            value = self._server.request_json(f"/object/{type}", "POST", value=value, timeout=timeout)
+        finally:
+            self.invalidate(None, type)
         return value["data"] if value["success"] else None
 
+    def new_many(self, values, type="item", depth=32, timeout=None):
+        assert type in self.NEW_TYPES
+        assert self.allow_write
+        request = lambda value: dict(endpoint=f"/object/{type}", method="POST", value=value)
+        try:
+            yield from self._batch(values, request, depth, timeout)
+        finally:
+            self.invalidate(None, type)
+
     EDIT_TYPES = {
         "item",
         "send",
@@ -116,13 +284,27 @@ class VaultServer:
         "org-collection",
     }
 
-    def edit(self, value, type="item"):
+    def edit(self, value, type="item", timeout=None):
         assert type in self.EDIT_TYPES
         assert self.allow_write
         uuid = value["uuid"]
-        value = self._server.request_json(f"/object/{type}/{uuid}", "PUT", value=value)
+        try:
+            value = self._server.request_json(f"/object/{type}/{uuid}", "PUT", value=value, timeout=timeout)
+        finally:
+            self.invalidate(uuid, type)
         return value["data"] if value["success"] else None
 
+    def edit_many(self, values, type="item", depth=32, timeout=None):
+        assert type in self.EDIT_TYPES
+        assert self.allow_write
+        request = lambda value: dict(endpoint=f"/object/{type}/{value['uuid']}", method="PUT", value=value)
+        try:
+            for value, result, error in self._batch(values, request, depth, timeout):
+                self.invalidate(value["uuid"], type)
+                yield value, result, error
+        finally:
+            self.invalidate(None, type)
+
     DELETE_TYPES = {
         "item",
         "send",
@@ -130,18 +312,39 @@ class VaultServer:
         "org-collection",
     }
 
-    def delete(self, uuid, type="item"):
+    def delete(self, uuid, type="item", timeout=None):
         assert self.allow_write
-        value = self._server.request_json(f"/object/{type}/{uuid}", "DELETE")
+        try:
+            value = self._server.request_json(f"/object/{type}/{uuid}", "DELETE", timeout=timeout)
+        finally:
+            self.invalidate(uuid, type)
+            if type != "item" and self.cache is not None:
+                # Items that were in a deleted folder or collection change too
+                self.cache.invalidate(lambda endpoint: endpoint.startswith(("/object/item/", "/list/object/items")))
         return value["success"]
 
+    def delete_many(self, uuids, type="item", depth=32, timeout=None):
+        assert self.allow_write
+        request = lambda uuid: dict(endpoint=f"/object/{type}/{uuid}", method="DELETE")
+        try:
+            for uuid, result, error in self._batch(uuids, request, depth, timeout):
+                self.invalidate(uuid, type)
+                yield uuid, error is None, error
+        finally:
+            self.invalidate(None, type)
+            if type != "item" and self.cache is not None:
+                self.cache.invalidate(lambda endpoint: endpoint.startswith(("/object/item/", "/list/object/items")))
+
     RESTORE_TYPES = {
         "item"
     }
 
-    def restore(self, uuid):
+    def restore(self, uuid, timeout=None):
         assert self.allow_write
-        value = self._server.request_json(f"/restore/item/{uuid}", "POST")
+        try:
+            value = self._server.request_json(f"/restore/item/{uuid}", "POST", timeout=timeout)
+        finally:
+            self.invalidate(uuid)
         return value["success"]
 
     LIST_TYPES = {
@@ -153,7 +356,7 @@ class VaultServer:
         "org-collections",
     }
 
-    def list(self, organization_id=None, collection_id=None, folder_id=None, url=None, trash=None, search=None, type="item"):
+    def list_request(self, organization_id=None, collection_id=None, folder_id=None, url=None, trash=None, search=None, type="item"):
         assert type in self.LIST_TYPES
         if type.rstrip("s") == "item":
             params = remove_none(dict(organizationId=organization_id, collectionId=collection_id, folderId=folder_id, url=url, trash=trash, search=search))
@@ -163,38 +366,56 @@ class VaultServer:
             type = "send"
         else:
             type = type.rstrip("s") + "s"
-        value = self._server.request_json(f"/list/object/{type}", "GET", params=params)
+        return f"/list/object/{type}", params
+
+    def list(self, organization_id=None, collection_id=None, folder_id=None, url=None, trash=None, search=None, type="item", timeout=None):
+        endpoint, params = self.list_request(organization_id, collection_id, folder_id, url, trash, search, type)
+        value = self._request_json(endpoint, params=params, timeout=timeout, priority=self._server.lane("bulk"))
         return value["data"]["data"] if value["success"] else None
 
-    def confirm(self, uuid, organization_id):
+    def iter_list(self, organization_id=None, collection_id=None, folder_id=None, url=None, trash=None, search=None, type="item", timeout=None):
+        endpoint, params = self.list_request(organization_id, collection_id, folder_id, url, trash, search, type)
+        body = None if self.cache is None else self.cache.get(self.cache.key(endpoint, params))
+        if body is not None:
+            yield from json.loads(body)["data"]["data"]
+        else:
+            yield from self._server.request_json_items(endpoint, "GET", ("data", "data"), params=params, timeout=timeout, priority=self._server.lane("bulk"))
+
+    def confirm(self, uuid, organization_id, timeout=None):
         assert self.allow_write
         params = dict(organizationId=organization_id)
-        value = self._server.request_json(f"/confirm/org-member/{uuid}", "POST", params=params)
+        try:
+            value = self._server.request_json(f"/confirm/org-member/{uuid}", "POST", params=params, timeout=timeout)
+        finally:
+            self.invalidate(uuid, "org-member")
         return value["success"]
 
-    def move(self, item_id, organization_id, collection_ids):
+    def move(self, item_id, organization_id, collection_ids, timeout=None):
         assert self.allow_write
-        value = self._server.request_json(f"/move/{item_id}/{organization_id}", "POST", value=collection_ids)
+        try:
+            value = self._server.request_json(f"/move/{item_id}/{organization_id}", "POST", value=collection_ids, timeout=timeout)
+        finally:
+            self.invalidate(item_id)
         return value
 
-    def pending(self, organization_id):
+    def pending(self, organization_id, timeout=None):
         assert self.allow_write
-        value = self._server.request_json(f"/device-approval/{organization_id}", "GET")
+        value = self._server.request_json(f"/device-approval/{organization_id}", "GET", timeout=timeout)
         #TODO: Check the return structure
         return value
 
-    def trust(self, organization_id, request_id=None):
+    def trust(self, organization_id, request_id=None, timeout=None):
         assert self.allow_write
         if request_id is None:
-            value = self._server.request_json(f"/device-approval/{organization_id}/approve-all", "POST")
+            value = self._server.request_json(f"/device-approval/{organization_id}/approve-all", "POST", timeout=timeout)
         else:
-            value = self._server.request_json(f"/device-approval/{organization_id}/approve/{request_id}", "POST")
+            value = self._server.request_json(f"/device-approval/{organization_id}/approve/{request_id}", "POST", timeout=timeout)
         return value["success"]
 
-    def deny(self, organization_id, request_id=None):
+    def deny(self, organization_id, request_id=None, timeout=None):
         assert self.allow_write
         if request_id is None:
-            value = self._server.request_json(f"/deny-approval/{organization_id}/deny-all", "GET")
+            value = self._server.request_json(f"/deny-approval/{organization_id}/deny-all", "GET", timeout=timeout)
         else:
-            value = self._server.request_json(f"/device-approval/{organization_id}/deny/{request_id}", "POST")
+            value = self._server.request_json(f"/device-approval/{organization_id}/deny/{request_id}", "POST", timeout=timeout)
         return value["success"]
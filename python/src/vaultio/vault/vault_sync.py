@@ -20,13 +20,13 @@ from pathlib import Path
 import subprocess
 
 import requests
-from vaultio.vault.api import MACError, create_derived_secrets, create_vault_secrets, decrypt_blob, decrypt_blob_stream, decrypt_ciphertext, decrypt_object, decrypt_object_key, decrypt_sync, download_attachment, download_sync, encrypt_ciphertext, encrypt_object, encrypt_sync, new_object_key, refresh_sync, request_attachment, update_request, upload_attachment
+from vaultio.vault.api import LazyObjects, MACError, create_derived_secrets, create_vault_secrets, decrypt_blob, decrypt_blob_stream, decrypt_ciphertext, decrypt_fields, decrypt_object, decrypt_object_key, decrypt_sync, download_attachment, download_sync, encrypt_ciphertext, encrypt_object, encrypt_sync, new_object_key, project_object, refresh_sync, request_attachment, update_request, upload_attachment
 from vaultio.util import CACHE_DIR, SYNC_CACHE, InputError, password_input
 from vaultio.vault.schema import make_cipher
 
 class VaultSync:
 
-    def __init__(self, encrypted=None, email=None, password=None, provider_choice=None, provider_token=None, cache=SYNC_CACHE) -> None:
+    def __init__(self, encrypted=None, email=None, password=None, provider_choice=None, provider_token=None, cache=SYNC_CACHE, workers=None, executor=None, lazy=False) -> None:
 
         if cache is not None and Path(cache).exists():
             with open(cache, "r") as fin:
@@ -46,6 +46,12 @@ class VaultSync:
 
         self.cache = cache
 
+        # Spread decryption and encryption of the ciphers over a pool
+        self.workers = workers
+        self.executor = executor
+        # Decrypt each cipher on first use instead of all of them on unlock
+        self.lazy = lazy
+
     def __enter__(self):
         return self
 
@@ -60,6 +66,8 @@ class VaultSync:
 
     def lock(self):
         self.encrypt(self.secrets)
+        if self.secrets is not None and "key_cache" in self.secrets:
+            self.secrets["key_cache"].clear()
         self.decrypted = None
         self.secrets = None
         return True
@@ -70,15 +78,22 @@ class VaultSync:
             return
 
         try:
-            self.encrypted |= encrypt_sync(self.decrypted, secrets)
+            self.encrypted |= encrypt_sync(self.decrypted, secrets, self.workers, self.executor)
         except (InputError, MACError):
             return False
 
-    def decrypt(self, secrets):
+    def decrypt(self, secrets, workers=None, executor=None):
+
+        if workers is None:
+            workers = self.workers
+        if executor is None:
+            executor = self.executor
 
         try:
             import copy
-            for item in copy.deepcopy(self.encrypted["ciphers"]).values():
+            # Looking for leftover items means decrypting every name
+            items = [] if self.lazy else copy.deepcopy(self.encrypted["ciphers"]).values()
+            for item in items:
                 try:
                     name = decrypt_ciphertext(item["name"], secrets).decode("utf-8")
                 except Exception:
@@ -88,7 +103,7 @@ class VaultSync:
                     assert input("Continue? ") == "y"
                     print()
                     update_request(self.encrypted, item["id"], "cipher", delete=True)
-            self.decrypted = decrypt_sync(self.encrypted, secrets)
+            self.decrypted = decrypt_sync(self.encrypted, secrets, workers, executor, self.lazy)
             self.secrets = secrets
             return True
         except Exception:
@@ -108,7 +123,7 @@ class VaultSync:
     def sync(self):
         self.encrypted = refresh_sync(self.encrypted)
         if self.secrets is not None:
-            self.decrypted = decrypt_sync(self.encrypted, self.secrets)
+            self.decrypted = decrypt_sync(self.encrypted, self.secrets, self.workers, self.executor, self.lazy)
         return True
 
     def status(self):
@@ -212,7 +227,9 @@ class VaultSync:
         "folder",
     }
 
-    def list(self, type="item"):
+    def list(self, type="item", fields=None):
+        if fields is not None:
+            return list(self.iter_list(type, fields))
         if type.rstrip("s") == "item":
             return list(self.decrypted["ciphers"].values())
         if type.rstrip("s") == "folder":
@@ -220,6 +237,24 @@ class VaultSync:
         else:
             raise NotImplementedError
 
+    def iter_list(self, type="item", fields=None):
+        if type.rstrip("s") == "item":
+            kind = "ciphers"
+        elif type.rstrip("s") == "folder":
+            kind = "folders"
+        else:
+            raise NotImplementedError
+        objects = self.decrypted[kind]
+        if fields is None:
+            yield from objects.values()
+            return
+        # Only decrypt the requested fields of objects not decrypted yet
+        for key in objects:
+            if isinstance(objects, LazyObjects) and not objects.is_loaded(key):
+                yield decrypt_fields(self.encrypted[kind][key], self.secrets, fields)
+            else:
+                yield project_object(objects[key], fields)
+
     def confirm(self, uuid, organization_id):
         raise NotImplementedError
 
@@ -1,12 +1,16 @@
+import fire
 import vaultio
 
-def main():
+# Moves the items of one collection to another. Only prints what it would
+# copy unless --live is passed.
 
-    with vaultio.VaultCLI(dry_run=True) as vault:
+def main(live=False):
+
+    with vaultio.Vault() as vault:
 
         vault.unlock()
 
-        collections = vault.list(type="collection")
+        collections = vault.list(type="collections")
 
         choices = {x["name"]: x for x in collections}
 
@@ -21,12 +25,29 @@ def main():
         src = choices[src]
         dst = choices[dst]
 
-        for item in vault.list(type="item"):
-            ids = set(item["collectionIds"])
-            if src["id"] in ids and dst["id"] not in ids:
-                item["organizationId"] = dst["organizationId"]
-                item["collectionIds"] = [dst["id"]]
-                new_item = vault.new(item, type="item")
-                vault.delete(item["id"], type="item")
+        def copies():
+            for item in vault.list(type="item"):
+                ids = set(item["collectionIds"])
+                if src["id"] in ids and dst["id"] not in ids:
+                    item = dict(item, organizationId=dst["organizationId"], collectionIds=[dst["id"]])
+                    yield item
+
+        if not live:
+            for item in copies():
+                print(f"Would copy {item['id']} ({item['name']}) to {dst['name']}")
+            return
+
+        # Only delete the originals that were copied
+        copied = []
+        for item, new_item, error in vault.new_many(copies(), type="item"):
+            if error is None:
+                copied.append(item["id"])
+            else:
+                print(f"Failed to copy {item['id']}: {error}")
+
+        for uuid, success, error in vault.delete_many(copied, type="item"):
+            if not success:
+                print(f"Failed to delete {uuid}: {error}")
 
-main()
+if __name__ == '__main__':
+    fire.Fire(main)
@@ -0,0 +1,77 @@
+# This file is part of vaultio.
+#
+# vaultio is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# vaultio is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with vaultio.  If not, see <https://www.gnu.org/licenses/>.
+
+import base64
+import hmac
+import os
+import random
+
+from cryptography.hazmat.primitives import padding
+from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+import pytest
+
+from vaultio.vault.api import MACError, decrypt_blocks, encrypt_ciphertext
+
+# decrypt_blocks runs every value through one CBC decryptor, so it is
+# checked against a separate modes.CBC cipher per value
+
+def make_secrets():
+    return dict(enc=os.urandom(32), mac=os.urandom(32))
+
+def pack(iv, text, secrets):
+    mac = hmac.digest(secrets["mac"], iv + text, "sha256")
+    return "2." + "|".join(base64.b64encode(x).decode() for x in (iv, text, mac))
+
+def encrypt_raw(plain, secrets, iv=None):
+    # Pads itself so a test can also produce bad padding
+    iv = os.urandom(16) if iv is None else iv
+    encryptor = Cipher(algorithms.AES(secrets["enc"]), modes.CBC(iv)).encryptor()
+    return iv, encryptor.update(plain) + encryptor.finalize()
+
+def reference(value, secrets):
+    iv, text, _ = (base64.b64decode(x) for x in value.partition(".")[2].split("|"))
+    decryptor = Cipher(algorithms.AES(secrets["enc"]), modes.CBC(iv)).decryptor()
+    unpadder = padding.PKCS7(128).unpadder()
+    return unpadder.update(decryptor.update(text) + decryptor.finalize()) + unpadder.finalize()
+
+@pytest.mark.parametrize("seed", range(5))
+def test_matches_cbc(seed):
+    rng = random.Random(seed)
+    secrets = make_secrets()
+    values = [encrypt_ciphertext(rng.randbytes(rng.randint(0, 100)), secrets) for _ in range(rng.randint(1, 50))]
+    assert decrypt_blocks(values, secrets) == [reference(value, secrets) for value in values]
+
+def test_empty():
+    assert decrypt_blocks([], make_secrets()) == []
+
+def test_mac_failure():
+    secrets = make_secrets()
+    values = [encrypt_ciphertext(b"first", secrets), encrypt_ciphertext(b"second", make_secrets())]
+    with pytest.raises(MACError):
+        decrypt_blocks(values, secrets)
+
+@pytest.mark.parametrize("plain", [b"\x00" * 16, b"a" * 15 + b"\x11", b"a" * 14 + b"\x01\x02", bytes(range(32))])
+def test_bad_padding(plain):
+    secrets = make_secrets()
+    good = encrypt_ciphertext(b"good", secrets)
+    bad = pack(*encrypt_raw(plain, secrets), secrets)
+    with pytest.raises(Exception, match="Wrong Password"):
+        decrypt_blocks([good, bad, good], secrets)
+
+@pytest.mark.parametrize("iv, text", [(os.urandom(16), b""), (os.urandom(16), os.urandom(20)), (os.urandom(8), os.urandom(16))])
+def test_bad_lengths(iv, text):
+    secrets = make_secrets()
+    with pytest.raises(Exception, match="Wrong Password"):
+        decrypt_blocks([encrypt_ciphertext(b"good", secrets), pack(iv, text, secrets)], secrets)
@@ -0,0 +1,59 @@
+# This file is part of vaultio.
+#
+# vaultio is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# vaultio is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with vaultio.  If not, see <https://www.gnu.org/licenses/>.
+
+import json
+
+import pytest
+
+from vaultio.vault.server import iter_json_items
+
+ITEMS = [
+    {"id": "id1", "name": "first", "fields": [1, 2.5, None]},
+    {"id": "id2", "name": "sécond", "login": {"uris": []}},
+    12345,
+    "text",
+    [],
+]
+
+def chunked(body, size):
+    data = body.encode()
+    return [data[i:i + size] for i in range(0, len(data), size)]
+
+def spaced_body(items):
+    # Whitespace around every structural character of the envelope
+    inner = " ,\n ".join(json.dumps(item, indent=1) for item in items)
+    return f' {{ "success" : true ,\n "data" : {{ "object" : "list" , "data" : [ \n {inner} \n ] \n }} \n }} '
+
+@pytest.mark.parametrize("size", [1, 2, 3, 7, 64, 4096])
+def test_items_in_small_chunks_with_whitespace(size):
+    body = spaced_body(ITEMS)
+    assert list(iter_json_items(chunked(body, size), ("data", "data"))) == ITEMS
+
+@pytest.mark.parametrize("size", [1, 5])
+def test_compact_body(size):
+    body = json.dumps(dict(success=True, data=dict(object="list", data=ITEMS)))
+    assert list(iter_json_items(chunked(body, size), ("data", "data"))) == ITEMS
+
+@pytest.mark.parametrize("size", [1, 4])
+def test_empty_and_missing_list(size):
+    assert list(iter_json_items(chunked(' { "data" : { "data" : [ ] } } ', size), ("data", "data"))) == []
+    assert list(iter_json_items(chunked(' { "success" : false , "message" : "x" } ', size), ("data", "data"))) == []
+
+def test_top_level_array():
+    assert list(iter_json_items(chunked(" [ 1 , 2 ,\n 3 ] ", 1), ())) == [1, 2, 3]
+
+def test_truncated_body():
+    with pytest.raises(ValueError):
+        list(iter_json_items(chunked('{"data": {"data": [1, 2', 1), ("data", "data")))
@@ -0,0 +1,232 @@
+# This file is part of vaultio.
+#
+# vaultio is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# vaultio is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with vaultio.  If not, see <https://www.gnu.org/licenses/>.
+
+from concurrent.futures import ThreadPoolExecutor
+import json
+import random
+import socket
+import threading
+import time
+
+import pytest
+
+import vaultio.vault.server as server_mod
+from vaultio.vault.server import Connection, RequestTimeoutError, Server
+
+# Many threads share one Server in front of a fake keep-alive bw serve. Every
+# response has to match the item it was requested for, and the socketpair
+# lock and pool slots have to be free again afterwards.
+
+THREADS = 64
+ROUNDS = 20
+UUIDS = [f"id{i}" for i in range(50)]
+
+def body_for(uuid):
+    # Sizes vary so an interleaved response can't parse as the right item
+    value = dict(success=True, data=dict(id=uuid, pad="x" * (int(uuid[2:]) * 397 % 9000)))
+    return json.dumps(value).encode()
+
+def serve_conn(sock, delay=0):
+    # Answers pipelined GET /object/item/<id> requests in order, writing
+    # each response in uneven pieces
+    rng = random.Random(id(sock))
+    pending = b""
+    with sock:
+        while True:
+            while b"\r\n\r\n" not in pending:
+                data = sock.recv(65536)
+                if not data:
+                    return
+                pending += data
+            head, pending = pending.split(b"\r\n\r\n", 1)
+            path = head.split(b"\r\n")[0].split(b" ")[1].decode()
+            body = body_for(path.rsplit("/", 1)[1])
+            time.sleep(delay)
+            resp = b"HTTP/1.1 200 OK\r\nContent-Type: application/json\r\nContent-Length: %d\r\n\r\n" % len(body) + body
+            while resp:
+                n = rng.randint(1, 4096)
+                sock.sendall(resp[:n])
+                resp = resp[n:]
+
+def serve_listener(listener):
+    with listener:
+        while True:
+            try:
+                sock, _ = listener.accept()
+            except OSError:
+                return
+            threading.Thread(target=serve_conn, args=(sock,), daemon=True).start()
+
+@pytest.fixture(params=["socketpair", "pool"])
+def server(request, tmp_path):
+    if request.param == "socketpair":
+        socks = socket.socketpair()
+        threading.Thread(target=serve_conn, args=(socks[1],), daemon=True).start()
+        server = Server(socks=socks, serve=False, wait=False, timeout=10)
+    else:
+        sock_path = str(tmp_path / "bw.sock")
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        listener.bind(sock_path)
+        listener.listen()
+        threading.Thread(target=serve_listener, args=(listener,), daemon=True).start()
+        server = Server(sock_path=sock_path, serve=False, wait=False, pool_size=4, timeout=10)
+    yield server
+    if server.pool is not None:
+        server.pool.close()
+    else:
+        server.conn.close()
+    if request.param == "pool":
+        listener.close()
+
+def get(server, uuid):
+    return server.request_json(f"/object/item/{uuid}", "GET")["data"]["id"]
+
+def get_many(server, uuids):
+    reqs = [dict(endpoint=f"/object/item/{uuid}", method="GET") for uuid in uuids]
+    return [value["data"]["id"] for value in server.request_json_many(reqs, depth=8, priority="bulk")]
+
+def check_balanced(server):
+    if server.pool is None:
+        lock = server.conn_lock
+        assert not lock.held
+        assert not any(lock.waiting.values())
+        assert server.conn_owner is None
+        assert server.conn.reusable and not server.conn.late
+    else:
+        pool = server.pool
+        assert len(pool.idle) == len(pool.conns) <= pool.size
+        slots = [pool.slots.acquire(blocking=False) for _ in range(pool.size)]
+        bulk_slots = [pool.bulk_slots.acquire(blocking=False) for _ in range(max(1, pool.size // 2))]
+        assert all(slots) and all(bulk_slots)
+        assert not pool.slots.acquire(blocking=False)
+        for _ in slots:
+            pool.slots.release()
+        for _ in bulk_slots:
+            pool.bulk_slots.release()
+
+def test_concurrent_requests(server):
+    uuids = UUIDS * ROUNDS
+    random.Random(0).shuffle(uuids)
+    with ThreadPoolExecutor(THREADS) as executor:
+        results = list(executor.map(lambda uuid: get(server, uuid), uuids))
+    assert results == uuids
+    check_balanced(server)
+
+def test_concurrent_batches(server):
+    rng = random.Random(1)
+    batches = [rng.sample(UUIDS, rng.randint(1, len(UUIDS))) for _ in range(THREADS * 2)]
+
+    def run(i):
+        # Mix batches with single interactive requests on the same server
+        if i % 3 == 0:
+            return [get(server, uuid) for uuid in batches[i]]
+        return get_many(server, batches[i])
+
+    with ThreadPoolExecutor(THREADS) as executor:
+        results = list(executor.map(run, range(len(batches))))
+    assert results == batches
+    check_balanced(server)
+
+def test_request_while_iterating(server):
+    # Results of a batch are read before they are yielded, so the
+    # connection is free for other requests inside the loop
+    reqs = [dict(endpoint=f"/object/item/{uuid}", method="GET") for uuid in UUIDS]
+    for value in server.request_json_many(reqs, depth=8):
+        uuid = value["data"]["id"]
+        assert get(server, uuid) == uuid
+    check_balanced(server)
+
+def test_expired_deadline_before_send():
+    socks = socket.socketpair()
+    with socks[0], socks[1]:
+        conn = Connection(socks[0])
+        conn.deadline = time.monotonic() - 1
+        with pytest.raises(RequestTimeoutError):
+            conn.sendall(b"GET / HTTP/1.1\r\n\r\n")
+        assert conn.reusable and conn.bytes_sent == 0
+
+def test_timeouts_keep_socketpair():
+    # Deadlines run out while waiting for the lock, skipping late responses
+    # and reading, and the socketpair stays usable afterwards
+    socks = socket.socketpair()
+    threading.Thread(target=serve_conn, args=(socks[1], .01), daemon=True).start()
+    server = Server(socks=socks, serve=False, wait=False)
+
+    def run(i):
+        timeouts = 0
+        for uuid in UUIDS:
+            try:
+                assert server.request_json(f"/object/item/{uuid}", "GET", timeout=.03)["data"]["id"] == uuid
+            except RequestTimeoutError:
+                timeouts += 1
+        return timeouts
+
+    with ThreadPoolExecutor(8) as executor:
+        timeouts = sum(executor.map(run, range(8)))
+    assert timeouts
+    time.sleep(.1)
+    assert [get(server, uuid) for uuid in UUIDS[:5]] == UUIDS[:5]
+    check_balanced(server)
+    server.conn.close()
+
+class FullFile:
+
+    # Destination that fails after the first write, like a full disk
+
+    def __init__(self):
+        self.writes = 0
+
+    def write(self, data):
+        self.writes += 1
+        if self.writes > 1:
+            raise OSError(28, "No space left on device")
+        return len(data)
+
+@pytest.mark.parametrize("mode", ["wb", "ab", "ab splice", "full"])
+def test_download_keeps_socketpair(tmp_path, monkeypatch, mode):
+    # Downloads go through splice where the file allows it, and a failed
+    # destination leaves the socketpair in step for the next request
+    if mode == "ab splice":
+        # Splice is tried anyway and has to fall back when it fails
+        monkeypatch.setattr(server_mod, "spliceable", lambda fd: True)
+        mode = "ab"
+    socks = socket.socketpair()
+    threading.Thread(target=serve_conn, args=(socks[1],), daemon=True).start()
+    server = Server(socks=socks, serve=False, wait=False, recv_sz=512)
+    uuid = "id49"
+    path = tmp_path / "body"
+    for _ in range(2):
+        if mode == "full":
+            with pytest.raises(OSError):
+                server.request_download(f"/object/item/{uuid}", "GET", FullFile())
+        else:
+            with open(path, mode) as fp:
+                assert server.request_download(f"/object/item/{uuid}", "GET", fp) == len(body_for(uuid))
+        assert get(server, "id3") == "id3"
+    if mode != "full":
+        assert path.read_bytes() == body_for(uuid) * (2 if mode == "ab" else 1)
+    check_balanced(server)
+    server.conn.close()
+
+def test_alive():
+    # Only an idle connection with nothing to read can be reused
+    for peer_action in (None, lambda peer: peer.sendall(b"x"), lambda peer: peer.shutdown(socket.SHUT_WR)):
+        a, b = socket.socketpair()
+        with a, b:
+            if peer_action is not None:
+                peer_action(b)
+            conn = Connection(a)
+            assert conn.alive() is (peer_action is None)
+            assert a.gettimeout() is None